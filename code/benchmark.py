@@ -0,0 +1,151 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This script measures the Python preprocessing on synthetic cohorts (see synthetic_cohort.py), by default of 25, 100 and 500
+# participants: eventlist generation (preprocessing_generate_eventlist.py), mean amplitudes with design matrix, baseline, electrode
+# positions and eventlist info (preprocessing_variables.py) and LIMO regressors (supplementary_scripts/LIMO_variables.py), each run
+# as in its script and in a fresh process. For every run it reports the wall time, the throughput (participants and words per
+# second) and the peak memory (resident set size of the main process and of the largest worker process, from getrusage).
+# Cohorts are written once and reused while their settings are unchanged; the design matrix caches are compiled before timing.
+# Results are appended to a csv. With --baseline (a previous results csv), runs slower or larger than the baseline by more than
+# --tolerance are listed and the script exits with status 1, so a performance regression fails the run.
+#
+# Usage: python benchmark.py /tmp/synthetic_cohort [--sizes 25 100 500] [--steps eventlist variables limo] [--workers 4]
+#                            [--output benchmark.csv] [--baseline benchmark_before.csv] [--tolerance 0.25]
+
+################################################################
+
+import argparse
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import limo_regressors
+import preprocessing_generate_eventlist
+from design_matrix import design_matrix, load_store
+from preprocessing_variables import write_variables
+from synthetic_cohort import read_settings, write_synthetic_cohort
+
+STEPS = ['eventlist', 'variables', 'limo']
+SIZES = [25, 100, 500]
+
+# Measures compared with the baseline
+MEASURES = ['seconds', 'peak_memory_mb', 'worker_peak_memory_mb']
+
+
+def _part_ids(section):
+    return ['part' + str(i) for i in range(1, section['part_num'] + 1)]
+
+
+def _limo_cache(section):
+    return os.path.splitext(section['sources']['audio'])[0] + '.pkl'
+
+
+# The steps, as run by the main block of each script
+def run_eventlist(section, workers):
+    info_onset = preprocessing_generate_eventlist.load_word_onsets(section['design_matrix'])
+    preprocessing_generate_eventlist.generate_cohort(_part_ids(section), section['path'], info_onset, workers)
+
+
+def run_variables(section, workers):
+    write_variables(section['mode'], section['path'], section['sources'], section['coordinates'], _part_ids(section),
+                    tuple(section['window']))
+
+
+def run_limo(section, workers):
+    info, info_index = design_matrix(load_store(section['sources'], _limo_cache(section)), section['mode'])
+    limo_regressors.write_cohort(_part_ids(section), section['path'], info, info_index, workers=workers)
+
+
+STEP_FUNCTIONS = {'eventlist': run_eventlist, 'variables': run_variables, 'limo': run_limo}
+
+
+# Running one step, in a fresh interpreter started for it (as when the script is run). ru_maxrss is in kilobytes on Linux; the
+# workers are the children of this process
+def _measure(step, section, workers):
+    start = time.perf_counter()
+    STEP_FUNCTIONS[step](section, workers)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'worker_peak_memory_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+# Cohort of part_num participants in root/part_num/, written if missing or written with other settings
+def prepare_cohort(root, part_num, seed=0):
+    path = os.path.join(root, str(part_num))
+    settings = read_settings(path)
+    if settings is None or settings['part_num'] != part_num or settings['seed'] != seed:
+        settings = write_synthetic_cohort(path, part_num, seed=seed)
+    config = settings['pipeline']
+    load_store(config['variables']['sources'], config['variables']['path'] + 'design_matrix.pkl')
+    load_store(config['limo']['sources'], _limo_cache(config['limo']))
+    preprocessing_generate_eventlist.load_word_onsets(config['eventlist']['design_matrix'])
+    return settings
+
+
+# Running the steps on cohorts of each size. Returns one row per step and cohort size
+def run_benchmark(root, sizes=SIZES, steps=STEPS, workers=None, seed=0):
+    rows = []
+    for part_num in sizes:
+        settings = prepare_cohort(root, part_num, seed)
+        for step in steps:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(_measure, step, settings['pipeline'][step], workers).result()
+            result.update({'step': step, 'participants': part_num, 'words': settings['words'],
+                           'participants_per_second': part_num / result['seconds'],
+                           'words_per_second': settings['words'] / result['seconds']})
+            rows.append(result)
+            print(step, part_num, 'participants:', round(result['seconds'], 2), 's,', round(result['peak_memory_mb']), 'MB')
+    results = pd.DataFrame(rows, columns=['step', 'participants', 'words', 'seconds', 'participants_per_second',
+                                          'words_per_second'] + MEASURES[1:])
+    results['workers'] = workers or os.cpu_count()
+    results['machine'] = platform.node()
+    results['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    return results
+
+
+# Runs whose time or peak memory grew by more than tolerance (0.25: 25%) compared with the latest baseline run of the same step
+# and cohort size
+def regressions(results, baseline, tolerance=0.25):
+    baseline = baseline.drop_duplicates(['step', 'participants'], keep='last')
+    merged = results.merge(baseline, on=['step', 'participants'], suffixes=('', '_baseline'))
+    rows = []
+    for measure in MEASURES:
+        ratio = merged[measure] / merged[measure + '_baseline']
+        slower = merged[ratio > 1 + tolerance]
+        rows += [{'step': row['step'], 'participants': row['participants'], 'measure': measure, 'value': row[measure],
+                  'baseline': row[measure + '_baseline'], 'ratio': row[measure] / row[measure + '_baseline']}
+                 for _, row in slower.iterrows()]
+    return pd.DataFrame(rows, columns=['step', 'participants', 'measure', 'value', 'baseline', 'ratio'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Timing the preprocessing on synthetic cohorts')
+    parser.add_argument('root', help='folder of the synthetic cohorts (one subfolder per size, written if missing)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of participants')
+    parser.add_argument('--steps', nargs='+', choices=STEPS, default=STEPS, help='steps to run')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic cohorts')
+    parser.add_argument('--output', default='benchmark.csv', help='csv the results are appended to')
+    parser.add_argument('--baseline', help='results csv of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative increase reported as a regression')
+    arguments = parser.parse_args()
+
+    pd.set_option('display.width', 400)
+    results = run_benchmark(arguments.root, arguments.sizes, arguments.steps, arguments.workers, arguments.seed)
+    print(results.to_string(index=False))
+    results.to_csv(arguments.output, mode='a', index=False, header=not os.path.exists(arguments.output))
+
+    if arguments.baseline is not None:
+        slower = regressions(results, pd.read_csv(arguments.baseline), arguments.tolerance)
+        if not slower.empty:
+            print('Regressions compared with ' + arguments.baseline + ':')
+            print(slower.to_string(index=False))
+            sys.exit(1)
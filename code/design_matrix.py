@@ -0,0 +1,117 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module compiles the design matrices (word information per bin) into one cached binary file.
+# The design matrices are read from csv/xlsx by every script, and each script derives the same bin_id mappings
+# (bin_id_audio, bin_id_video, bin_id_prev...). Here each source is parsed once, stored with its dtypes, together with a dense
+# array per bin_id column (bin_id -> row, -1 for bins that are not in the design matrix), so that looking up the words of a list
+# of bins is an array gather rather than a merge. The cache is rebuilt when a source file changes (size or modification time).
+
+################################################################
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from file_utils import atomic_write
+
+# Readers of the design matrix sources, by file extension
+READERS = {'.csv': pd.read_csv, '.xlsx': pd.read_excel, '.parquet': pd.read_parquet} # parquet: see prosody_ingestion.py
+
+# Columns holding bin ids, the design matrices are indexed by each of them when present and unique
+BIN_COLUMNS = ['bin_id', 'bin_id_audio', 'bin_id_video', 'bin_id_prev']
+
+# Design matrix and bin_id column used by each data slice. The sources are named as in default_sources
+MODES = {
+    'audio': ('audio_seq', 'bin_id_audio'), # preprocessing_variables.py
+    'video': ('audio_seq', 'bin_id_video'),
+    'video_replication': ('replication', 'bin_id'),
+    'limo_audio': ('audio', 'bin_id'), # LIMO_variables.py
+    'limo_video': ('audio', 'bin_id_prev'),
+}
+
+
+# Design matrix files in the stimuli folder
+def default_sources(stimuli_path):
+    return {
+        'audio_seq': os.path.join(stimuli_path, 'word_merged_audio_seq.csv'),
+        'replication': os.path.join(stimuli_path, 'word_merged_replication_surprisal.csv'),
+        'audio': os.path.join(stimuli_path, 'word_merged_audio.xlsx'),
+    }
+
+
+# Dense bin_id -> row array. Rows without bin_id (e.g. words not shown in the video slice) are not indexed
+def dense_index(keys, name='design matrix'):
+    keys = pd.Series(keys)
+    rows = np.flatnonzero(keys.notna().to_numpy())
+    key_values = keys.to_numpy()[rows].astype(np.int64)
+    if len(np.unique(key_values)) != len(key_values):
+        raise ValueError('Duplicate keys in ' + name + ', the lookup needs one row per key')
+    index = np.full(int(key_values.max(initial=-1)) + 1, -1, dtype=np.int64)
+    index[key_values] = rows
+    return index
+
+
+# Rows of the query bins in a dense index, -1 for bins that are not indexed
+def gather_index(index, query):
+    query = np.asarray(query, dtype=np.int64)
+    positions = np.full(len(query), -1, dtype=np.int64)
+    inside = (query >= 0) & (query < len(index))
+    positions[inside] = index[query[inside]]
+    return positions
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+# Reading the sources and building the indexes
+def compile_store(sources):
+    store = {'signature': {}, 'tables': {}, 'indexes': {}}
+    for name, path in sources.items():
+        table = READERS[os.path.splitext(path)[1]](path)
+        store['signature'][name] = _signature(path)
+        store['tables'][name] = table
+        for column in BIN_COLUMNS:
+            if column in table.columns and table[column].dropna().is_unique:
+                store['indexes'][name, column] = dense_index(table[column], name + ' ' + column)
+    return store
+
+
+# Loading the compiled store from cache_path, compiling it again if a source was added or changed since it was written
+def load_store(sources, cache_path):
+    signature = {name: _signature(path) for name, path in sources.items()}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            store = pickle.load(f)
+        if store['signature'] == signature:
+            return store
+
+    store = compile_store(sources)
+    with atomic_write(cache_path) as f: # readers never see a half written cache
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return store
+
+
+# Design matrix of a mode with its bin_id column copied to 'bin_id' (as in the analysis scripts), and the dense index of that column
+def design_matrix(store, mode):
+    name, column = MODES[mode]
+    if (name, column) not in store['indexes']:
+        raise ValueError(column + ' is missing or not unique in the ' + name + ' design matrix')
+    info = store['tables'][name].copy()
+    info['bin_id'] = info[column]
+    return info, store['indexes'][name, column]
+
+
+# Values of a design matrix column for a list of bins, NaN for bins that are not in the design matrix
+def lookup_column(info, index, column, bin_ids):
+    return info[column].reset_index(drop=True).reindex(gather_index(index, bin_ids)).reset_index(drop=True)
+
+
+# Rows of the design matrix for a list of bins (a left join on bin_id), NaN rows for bins that are not in the design matrix
+def lookup_rows(info, index, bin_ids):
+    return info.reset_index(drop=True).reindex(gather_index(index, bin_ids)).reset_index(drop=True)
@@ -0,0 +1,155 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module groups electrodes into regions of interest (ROIs), so that the LMER table can have one row per participant x word x
+# ROI instead of one per electrode (32 times smaller with a single ROI such as the centro-parietal N400 sites).
+# ROIs are named lists of electrodes: the Michaelov et al. (2021) recoding used in audio_lmer.R, the N400 sites, neighbourhoods of
+# an electrode (its k nearest electrodes or those within a radius, from channel_coordinate.csv) or data-driven clusters of the
+# coordinates. ERP and baseline are averaged within each ROI before the long table is built (see lmer_join.py), and each ROI gets
+# the mean x, y, z of its electrodes, so the ROI table goes through the same join as the electrode table.
+
+################################################################
+
+import numpy as np
+import pandas as pd
+
+from lmer_join import read_measurement
+
+# Named ROIs. Michaelov et al. (2021) as recoded in audio_lmer.R (where the membership of F and CP electrodes is a guess), and
+# the centro-parietal sites where the N400 is usually largest
+ROIS = {
+    'prefrontal': ['Fp1', 'Fp2', 'AF3', 'AF4'],
+    'fronto-central': ['F3', 'F7', 'Fz', 'F4', 'F8', 'FC5', 'FC1', 'FC6', 'FC2'],
+    'central': ['C3', 'C4', 'Cz'],
+    'posterior': ['CP1', 'CP5', 'CP2', 'CP6', 'P3', 'P7', 'Pz', 'P4', 'P8', 'PO3', 'PO4', 'O1', 'Oz', 'O2'],
+    'left temporal': ['T7'],
+    'right temporal': ['T8'],
+    'N400': ['C3', 'Cz', 'C4', 'CP1', 'CP2', 'P3', 'Pz', 'P4'],
+}
+
+MICHAELOV_ROIS = ['prefrontal', 'fronto-central', 'central', 'posterior', 'left temporal', 'right temporal']
+
+
+# Reading the electrode coordinates (channel_coordinate.csv) as electrode, x, y, z
+def read_coordinates(path):
+    coordinates = pd.read_csv(path)
+    coordinates.columns = ['electrode', 'x', 'y', 'z']
+    coordinates['electrode'] = coordinates['electrode'].str.strip(' ')
+    return coordinates
+
+
+# Electrode x electrode distances. With 32-64 electrodes the full matrix is cheaper than building a k-d tree
+def _distances(coordinates):
+    positions = coordinates[['x', 'y', 'z']].to_numpy(dtype=float)
+    return np.sqrt(((positions[:, None, :] - positions[None, :, :]) ** 2).sum(axis=2))
+
+
+# Neighbour lists: for each electrode, the other electrodes within radius (same unit as the coordinates) and/or its k nearest,
+# closest first
+def electrode_neighbours(coordinates, radius=None, k=None):
+    if radius is None and k is None:
+        raise ValueError('Give a radius and/or a number of neighbours k')
+    distances = _distances(coordinates)
+    electrodes = coordinates['electrode'].to_numpy()
+    neighbours = {}
+    for i, electrode in enumerate(electrodes):
+        order = [j for j in np.argsort(distances[i], kind='stable') if j != i]
+        if k is not None:
+            order = order[:k]
+        if radius is not None:
+            order = [j for j in order if distances[i, j] <= radius]
+        neighbours[electrode] = list(electrodes[order])
+    return neighbours
+
+
+# ROI made of an electrode and its neighbours, e.g. neighbourhood_roi(coordinates, 'Pz', k=6)
+def neighbourhood_roi(coordinates, centre, radius=None, k=None):
+    return [centre] + electrode_neighbours(coordinates, radius, k)[centre]
+
+
+# Data-driven ROIs: k-means clusters of the electrode coordinates (named cluster1, cluster2...). The clusters start from
+# electrodes far apart (the first electrode, then the farthest from those chosen), so the result is the same at every run
+def cluster_electrodes(coordinates, n_clusters, max_iterations=100):
+    positions = coordinates[['x', 'y', 'z']].to_numpy(dtype=float)
+    distances = _distances(coordinates)
+    chosen = [0]
+    while len(chosen) < n_clusters:
+        chosen.append(int(distances[:, chosen].min(axis=1).argmax()))
+    centres = positions[chosen]
+    labels = None
+    for _ in range(max_iterations):
+        new_labels = ((positions[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        centres = np.array([positions[labels == i].mean(axis=0) if (labels == i).any() else centres[i]
+                            for i in range(n_clusters)])
+    electrodes = coordinates['electrode'].to_numpy()
+    return {'cluster' + str(i + 1): list(electrodes[labels == i]) for i in range(n_clusters) if (labels == i).any()}
+
+
+# Electrodes x ROIs membership matrix (an electrode can be in several ROIs)
+def roi_membership(electrodes, rois):
+    electrodes = pd.Index(electrodes)
+    membership = np.zeros((len(electrodes), len(rois)))
+    for i, (name, members) in enumerate(rois.items()):
+        positions = electrodes.get_indexer(members)
+        if (positions < 0).any():
+            missing = [member for member, position in zip(members, positions) if position < 0]
+            raise ValueError('Unknown electrodes in ROI ' + name + ': ' + ', '.join(missing))
+        membership[positions, i] = 1
+    return membership
+
+
+# ROI of each electrode (the first ROI containing it, NaN if none), e.g. the ROI column of audio_lmer.R:
+# roi_labels(data['electrode'], {name: ROIS[name] for name in MICHAELOV_ROIS})
+def roi_labels(electrodes, rois):
+    labels = {}
+    for name, members in rois.items():
+        for member in members:
+            labels.setdefault(member, name)
+    return pd.Series(electrodes).map(labels)
+
+
+# Coordinates of the ROIs (mean x, y, z of their electrodes), in the format of the electrode coordinates
+def roi_coordinates(coordinates, rois):
+    membership = roi_membership(coordinates['electrode'], rois)
+    centres = membership.T @ coordinates[['x', 'y', 'z']].to_numpy(dtype=float) / membership.sum(axis=0)[:, None]
+    table = pd.DataFrame(centres, columns=['x', 'y', 'z'])
+    table.insert(0, 'electrode', list(rois))
+    return table
+
+
+# Averaging a measurement (an ERPlab export path, or a table as returned by read_measurement) within each ROI. Returns the same
+# columns, with the ROI names as electrodes. Electrodes missing for a word are left out of its averages
+def average_rois(table, rois, value_name):
+    if isinstance(table, str):
+        table = read_measurement(table, value_name)
+    electrode = table['electrode'].astype('category')
+    part_id = table['part_id'].astype('category')
+    membership = roi_membership(electrode.cat.categories, rois)
+
+    # Participant x bin rows, electrode columns
+    bin_id = table['bin_id'].to_numpy(dtype=np.int64)
+    keys = part_id.cat.codes.to_numpy(dtype=np.int64) * (int(bin_id.max(initial=0)) + 1) + bin_id
+    groups, group_rows = np.unique(keys, return_inverse=True)
+    values = np.full((len(groups), len(membership)), np.nan)
+    values[group_rows, electrode.cat.codes.to_numpy()] = table[value_name].to_numpy(dtype=float)
+
+    present = ~np.isnan(values)
+    counts = present @ membership
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (np.where(present, values, 0) @ membership) / counts
+
+    first = np.zeros(len(groups), dtype=np.int64)
+    first[group_rows[::-1]] = np.arange(len(group_rows))[::-1] # a row of each group, for its part_id and bin_id
+    n_rois = len(rois)
+    kept = counts.ravel() > 0 # words without any electrode of a ROI get no row for it
+    return pd.DataFrame({
+        value_name: means.ravel()[kept],
+        'electrode': pd.Categorical.from_codes(np.tile(np.arange(n_rois), len(groups))[kept], list(rois)),
+        'bin_id': np.repeat(bin_id[first], n_rois)[kept],
+        'part_id': pd.Categorical.from_codes(np.repeat(part_id.cat.codes.to_numpy()[first], n_rois)[kept],
+                                             part_id.cat.categories),
+    })
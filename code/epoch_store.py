@@ -0,0 +1,143 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module keeps the epoched EEG data (participant x epoch x channel x time) as memory-mapped NumPy files, so that mean
+# amplitudes can be computed for any time window without exporting it from ERPlab first (as done for lmer/300-500.txt,
+# lmer/baseline.txt and the 300-600 window of the replication data).
+# A store is a folder with meta.json (sample times in ms, channel labels) and, per participant, partN.npy (epochs x channels x
+# samples, float32), partN_bins.npy (bin of each epoch) and partN_good.npy (epochs kept after artifact rejection).
+# All windows are averaged in one pass over the data, as a product with a samples x windows weight matrix. In this paradigm each
+# bin is one word seen once, so the mean over a window of an epoch is the ERP amplitude that ERPlab exports for its bin.
+
+################################################################
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+CHUNK_EPOCHS = 256 # epochs read at once when averaging, bounding memory use for large participants
+
+
+def _meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+# Creating an empty store. times: sample latencies in ms, channels: channel labels in the order of the data
+def create_store(path, times, channels):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'times': [float(time) for time in times], 'channels': [str(channel).strip() for channel in channels]}, f)
+
+
+# Adding the epochs of a participant. data: epochs x channels x samples (any array-like, e.g. a memmap of the EEGlab .fdt file),
+# bin_ids: bin of each epoch, good: epochs kept after artifact rejection (all by default)
+def add_participant(path, part_id, data, bin_ids, good=None):
+    meta = _meta(path)
+    n_epochs = len(bin_ids)
+    shape = (n_epochs, len(meta['channels']), len(meta['times']))
+    if tuple(data.shape) != shape:
+        raise ValueError('Data of ' + part_id + ' has shape ' + str(tuple(data.shape)) + ', expected ' + str(shape))
+
+    epochs = np.lib.format.open_memmap(os.path.join(path, part_id + '.npy'), mode='w+', dtype=np.float32, shape=shape)
+    for start in range(0, n_epochs, CHUNK_EPOCHS):
+        epochs[start:start + CHUNK_EPOCHS] = data[start:start + CHUNK_EPOCHS]
+    epochs.flush()
+    del epochs
+    np.save(os.path.join(path, part_id + '_bins.npy'), np.asarray(bin_ids, dtype=np.int64))
+    np.save(os.path.join(path, part_id + '_good.npy'), np.ones(n_epochs, dtype=bool) if good is None else np.asarray(good, dtype=bool))
+
+
+# Adding a participant from an epoched EEGlab dataset (.set, with the data in the .set file or in a .fdt file next to it).
+# The bin of each epoch is the ERPlab bin of its time-locking event, rejected epochs are read from EEG.reject.rejmanual
+def import_eeglab(path, part_id, set_path):
+    from scipy.io import loadmat
+    eeg = loadmat(set_path, squeeze_me=True, struct_as_record=False)
+    eeg = eeg.get('EEG', eeg) # datasets saved with pop_saveset keep the fields at top level
+    field = (lambda name: getattr(eeg, name)) if hasattr(eeg, 'nbchan') else (lambda name: eeg[name])
+    n_channels, n_samples, n_epochs = int(field('nbchan')), int(field('pnts')), int(field('trials'))
+
+    if isinstance(field('data'), str): # float32 data in a separate file, channels x samples x epochs in column-major order
+        data = np.memmap(os.path.join(os.path.dirname(set_path), field('data')), dtype=np.float32, mode='r',
+                         shape=(n_channels, n_samples, n_epochs), order='F')
+    else:
+        data = np.asarray(field('data'), dtype=np.float32).reshape(n_channels, n_samples, n_epochs)
+
+    bin_ids = []
+    for epoch in np.atleast_1d(field('epoch')):
+        bins = np.atleast_1d(epoch.eventbini)
+        latencies = np.atleast_1d(epoch.eventlatency)
+        locking = [i for i, latency in enumerate(latencies) if np.ravel(latency)[0] == 0]
+        bin_id = np.ravel(bins[locking[0] if locking else 0])
+        bin_ids.append(int(bin_id[0]))
+    reject = getattr(field('reject'), 'rejmanual', None)
+    good = None if reject is None or np.size(reject) != n_epochs else ~np.asarray(reject, dtype=bool)
+
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        times = np.arange(n_samples) * 1000.0 / float(field('srate')) + float(field('xmin')) * 1000
+        create_store(path, times, [channel.labels for channel in np.atleast_1d(field('chanlocs'))])
+    add_participant(path, part_id, data.transpose(2, 0, 1), bin_ids, good)
+
+
+# Participants in a store
+def list_participants(path):
+    return sorted((name[:-len('.npy')] for name in os.listdir(path)
+                   if name.endswith('.npy') and not name.endswith(('_bins.npy', '_good.npy'))),
+                  key=lambda name: (len(name), name))
+
+
+# Epochs of a participant (memory-mapped, epochs x channels x samples), with the bin and artifact rejection flag of each epoch
+def open_participant(path, part_id):
+    return (np.load(os.path.join(path, part_id + '.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, part_id + '_bins.npy')),
+            np.load(os.path.join(path, part_id + '_good.npy')))
+
+
+# Samples x windows matrix averaging the samples of each window. windows: name -> (start, end) in ms, both ends included
+def window_weights(times, windows):
+    times = np.asarray(times)
+    weights = np.zeros((len(times), len(windows)))
+    for i, (name, (start, end)) in enumerate(windows.items()):
+        inside = (times >= start) & (times <= end)
+        if not inside.any():
+            raise ValueError('No samples in window ' + name + ' (' + str(start) + ' to ' + str(end) + ' ms)')
+        weights[inside, i] = 1.0 / inside.sum()
+    return weights
+
+
+# Mean amplitudes of every window for every epoch and channel of a participant, as epochs x channels x windows
+def participant_window_means(epochs, weights):
+    means = np.empty(epochs.shape[:2] + (weights.shape[1],))
+    for start in range(0, len(epochs), CHUNK_EPOCHS):
+        means[start:start + CHUNK_EPOCHS] = np.asarray(epochs[start:start + CHUNK_EPOCHS], dtype=np.float64) @ weights
+    return means
+
+
+# Long table of mean amplitudes (one row per participant x epoch x electrode, one column per window), in the format of the
+# measurements read in lmer_join.py (electrode, bin_id and part_id as keys). Rejected epochs are left out unless include_rejected,
+# as ERPlab exports 0 for bins without accepted epochs
+def window_means(path, windows, part_ids=None, include_rejected=False):
+    meta = _meta(path)
+    weights = window_weights(meta['times'], windows)
+    part_ids = list_participants(path) if part_ids is None else list(part_ids)
+    n_channels = len(meta['channels'])
+
+    slices = []
+    for part_code, part_id in enumerate(part_ids):
+        epochs, bin_ids, good = open_participant(path, part_id)
+        means = participant_window_means(epochs, weights)
+        kept = slice(None) if include_rejected else good
+        means, bin_ids = means[kept], bin_ids[kept]
+        table = {name: means[:, :, i].ravel() for i, name in enumerate(windows)}
+        table['electrode'] = np.tile(np.arange(n_channels), len(bin_ids))
+        table['bin_id'] = np.repeat(bin_ids, n_channels)
+        table['part_id'] = np.full(len(bin_ids) * n_channels, part_code)
+        slices.append(pd.DataFrame(table))
+
+    table = pd.concat(slices, ignore_index=True) if slices else pd.DataFrame(columns=list(windows) + ['electrode', 'bin_id', 'part_id'])
+    table['electrode'] = pd.Categorical.from_codes(table['electrode'].astype(np.int64), meta['channels'])
+    table['part_id'] = pd.Categorical.from_codes(table['part_id'].astype(np.int64), part_ids)
+    return table
@@ -0,0 +1,56 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module reads eventlists exported from ERPLAB (e.g. eventlist_export_AR_part1.txt, exported after artifact rejection).
+# An export starts with a header block (non-editable header, one line per bin descriptor and the commented column names), so the
+# number of lines to skip depends on the number of bins and differs between the audio and video data.
+# The reader memory-maps the file to find where the event table starts, then parses the columns used in the analysis from there.
+
+################################################################
+
+import mmap
+
+import numpy as np
+import pandas as pd
+
+# Column positions in the tab separated event table. The artifact and user flags share one field, e.g. '    00000000     00000000'
+EPOCH_COLUMN = 1
+BIN_COLUMN = 2
+FLAG_COLUMN = 7
+
+
+# Finding the byte offset of the first event: the table follows the last commented line of the header
+def find_table_offset(buffer):
+    last_comment = buffer.rfind(b'\n#') + 1
+    if last_comment == 0 and buffer[:1] != b'#':
+        return 0 # no header
+    line_end = buffer.find(b'\n', last_comment)
+    return len(buffer) if line_end == -1 else line_end + 1
+
+
+# Packing the flag strings into integers (the two 8 bit groups as one 16 bit value), parsing each distinct string only once
+def pack_flags(flags):
+    unique_flags, inverse = np.unique(np.asarray(flags, dtype=str), return_inverse=True)
+    packed = np.array([int(''.join(flag.split()) or '0', 2) for flag in unique_flags], dtype=np.uint16)
+    return packed[inverse]
+
+
+# Reading an exported eventlist. Returns a dict of NumPy arrays:
+# bin_id (ecode), epoch (bepoch), ar_flags (packed flags) and ar_good (True when no flag is set)
+def read_eventlist_export(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            offset = find_table_offset(buffer)
+        f.seek(offset) # the table is parsed from the file, without copying it out of the map
+        table = pd.read_csv(f, sep='\t', header=None, usecols=[EPOCH_COLUMN, BIN_COLUMN, FLAG_COLUMN],
+                            dtype={FLAG_COLUMN: str}, skip_blank_lines=True)
+
+    flags = table[FLAG_COLUMN]
+    ar_flags = pack_flags(flags.fillna('').to_numpy())
+    return {
+        'bin_id': table[BIN_COLUMN].to_numpy(dtype=np.int64),
+        'epoch': table[EPOCH_COLUMN].to_numpy(dtype=np.int64),
+        'ar_flags': ar_flags,
+        'ar_good': (ar_flags == 0) & flags.notna().to_numpy(), # events without flags are not counted as good
+    }
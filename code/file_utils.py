@@ -0,0 +1,36 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module holds the file helpers shared by the cached steps (design matrix store, model fits, n-gram counts and the state of
+# pipeline.py): the hash of a file content, read in blocks, and writing a file through a temporary file that replaces it in one
+# step, so that readers never see a half written file.
+
+################################################################
+
+import hashlib
+import os
+from contextlib import contextmanager
+
+
+# Hash of a file content, read in blocks
+def content_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Opening path for writing through path.tmp, which replaces path once the block is done (and is removed if the block fails)
+@contextmanager
+def atomic_write(path, mode='wb'):
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, mode) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
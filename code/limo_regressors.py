@@ -0,0 +1,121 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module computes the regressors for the LIMO analysis (surprisal and prominence of each word, in the order of presentation)
+# and writes them per participant. All regressors of a participant are computed in one pass as a words x regressors matrix, and
+# written either as one text file per regressor (partN_prom.txt, partN_surp_ngram.txt..., as read by LIMO so far) or as a single
+# binary matrix (partN_regressors.npy, or partN_regressors.mat for MATLAB, with the regressor names). Participants run in a
+# process pool. New surprisal models only need a new entry in REGRESSORS.
+
+################################################################
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from design_matrix import gather_index, lookup_rows
+from erplab_eventlist import read_eventlist_export
+
+# Regressors written for LIMO: file suffix -> (design matrix column, only content words)
+REGRESSORS = {
+    'prom': ('prominence_label', False),
+    'surp_ngram': ('surprisal_ngram', False),
+    'surp_gpt': ('surprisal_gpt', False),
+    'surp_bert': ('surprisal_bert', False),
+    'surp_ngram_content': ('surprisal_ngram', True),
+    'surp_gpt_content': ('surprisal_gpt', True),
+    'surp_bert_content': ('surprisal_bert', True),
+}
+
+# Values excluded (set to NaN) from a column before it is used as regressor
+EXCLUDED_VALUES = {'prominence_label': [3]} # exclude words with prominence label 3
+
+OUTPUT_FORMATS = ('txt', 'npy', 'mat')
+
+# Design matrix and its bin index, handed to each worker process when it starts
+_info = None
+_info_index = None
+
+
+# Content words have pos_prev 1, function words (pos_prev 0) and words without POS info are masked in the content regressors
+def content_words(events_info):
+    pos = events_info['pos_prev'].to_numpy(dtype=float)
+    return ~np.isnan(pos) & (pos != 0)
+
+
+# Computing all regressors of a participant at once, as a words x regressors matrix
+def compute_regressors(events_info, regressors=REGRESSORS):
+    columns = [column for column, _ in regressors.values()]
+    unique_columns = list(dict.fromkeys(columns))
+    values = events_info[unique_columns].to_numpy(dtype=float)
+    for i, column in enumerate(unique_columns):
+        if column in EXCLUDED_VALUES:
+            values[np.isin(values[:, i], EXCLUDED_VALUES[column]), i] = np.nan
+
+    matrix = values[:, [unique_columns.index(column) for column in columns]]
+    content_only = np.array([content for _, content in regressors.values()], dtype=bool)
+    matrix[np.outer(~content_words(events_info), content_only)] = np.nan
+    return matrix
+
+
+# Writing a regressor matrix. txt: one file per regressor (NaN for missing values), npy/mat: one file with all regressors
+def write_regressors(matrix, names, output_path, part_id, output_format='txt'):
+    prefix = os.path.join(output_path, part_id + '_')
+    if output_format == 'txt':
+        for i, name in enumerate(names):
+            with open(prefix + name + '.txt', 'w') as f:
+                f.write(''.join('NaN\n' if np.isnan(value) else repr(float(value)) + '\n' for value in matrix[:, i]))
+    elif output_format == 'npy':
+        np.save(prefix + 'regressors.npy', matrix)
+        with open(prefix + 'regressors_names.txt', 'w') as f:
+            f.write('\n'.join(names) + '\n')
+    elif output_format == 'mat':
+        from scipy.io import savemat
+        savemat(prefix + 'regressors.mat', {'regressors': matrix, 'names': np.array(names, dtype=object)})
+    else:
+        raise ValueError('Unknown output format ' + str(output_format) + ', use one of ' + ', '.join(OUTPUT_FORMATS))
+
+
+# Regressors of one participant: the words of the exported eventlist (in order of presentation) with their design matrix rows.
+# If audit is a list, the number of words and of words found in the design matrix is appended to it
+def participant_regressors(eventlist_path, info, info_index, regressors=REGRESSORS, audit=None):
+    bin_ids = read_eventlist_export(eventlist_path)['bin_id']
+    if audit is not None:
+        audit.append({'step': 'design matrix', 'rows_in': len(bin_ids), 'rows_out': int((gather_index(info_index, bin_ids) >= 0).sum())})
+    return compute_regressors(lookup_rows(info, info_index, bin_ids), regressors)
+
+
+def _init_worker(info, info_index):
+    global _info, _info_index
+    _info, _info_index = info, info_index
+
+
+# Paths of the exported eventlist and of the LIMO folder of a participant
+def participant_paths(path, part_id):
+    return (os.path.join(path, 'eventlist', 'export', 'eventlist_export_' + part_id + '.txt'),
+            os.path.join(path, 'LIMO', 'data', part_id))
+
+
+# Writing the regressors of one participant. info/info_index are the design matrix and its bin index, by default the ones shared
+# with the worker by write_cohort
+def write_participant(part_id, path, output_format='txt', regressors=REGRESSORS, audit=None, info=None, info_index=None):
+    if info is None:
+        info, info_index = _info, _info_index
+    if info is None:
+        raise ValueError('No design matrix: pass info and info_index (see design_matrix.py) or run the participants with write_cohort')
+    eventlist_path, output_path = participant_paths(path, part_id)
+    matrix = participant_regressors(eventlist_path, info, info_index, regressors, audit)
+    write_regressors(matrix, list(regressors), output_path, part_id, output_format)
+    return output_path
+
+
+# Writing the regressors of a cohort in a process pool. info/info_index are the design matrix and its bin index (see design_matrix.py)
+def write_cohort(part_ids, path, info, info_index, output_format='txt', regressors=REGRESSORS, workers=None):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format ' + str(output_format) + ', use one of ' + ', '.join(OUTPUT_FORMATS))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(info, info_index)) as pool:
+        return list(pool.map(partial(write_participant, path=path, output_format=output_format, regressors=regressors),
+                             part_ids))
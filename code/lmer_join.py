@@ -0,0 +1,166 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module builds the long table used in the LMER analysis (one row per participant x word x electrode), combining the ERP
+# measurements exported from ERPlab with baseline, design matrix, electrode coordinates and (optionally) eventlist info.
+# Chaining pd.merge over the whitespace padded string keys keeps every intermediate table alive and hashes the strings at each
+# step. Here the keys are encoded once (part_id and electrode as categorical codes, bin_id as integer), the small tables are joined
+# by array lookups, and the rows to keep are tracked as positions so that each output column is only gathered once at the end.
+
+################################################################
+
+import numpy as np
+import pandas as pd
+
+from design_matrix import dense_index, gather_index
+
+# Column names in the ERPlab measurement export and their names in the long table
+MEASUREMENT_COLUMNS = {'       value': None, '     chlabel': 'electrode', '        bini': 'bin_id', 'ERPset': 'part_id'}
+
+
+# Reading one ERPlab measurement export (e.g. 300-500.txt or baseline.txt), with electrode and part_id as categories
+def read_measurement(path, value_name):
+    table = pd.read_csv(path, sep='\t', usecols=list(MEASUREMENT_COLUMNS),
+                        dtype={'     chlabel': 'category', 'ERPset': 'category'})
+    table.rename(columns={column: name or value_name for column, name in MEASUREMENT_COLUMNS.items()}, inplace=True)
+    table['electrode'] = strip_categories(table['electrode'])
+    return table
+
+
+# Measurement table from a path or a table, with electrode and part_id as categories
+def _measurement(table, value_name):
+    if isinstance(table, str):
+        return read_measurement(table, value_name)
+    table = table[[value_name, 'electrode', 'bin_id', 'part_id']].astype({'electrode': 'category', 'part_id': 'category'})
+    table['electrode'] = strip_categories(table['electrode'])
+    return table
+
+
+# Stripping the padding of categorical labels, only touching each distinct label once
+def strip_categories(column):
+    stripped = column.cat.categories.str.strip()
+    if stripped.is_unique:
+        return column.cat.rename_categories(stripped)
+    return column.astype(str).str.strip().astype('category')
+
+
+# Positions of query keys in a table of unique keys, -1 where a key is missing
+def unique_lookup(keys, query, name):
+    index = pd.Index(keys)
+    if not index.is_unique:
+        raise ValueError('Duplicate keys in ' + name + ', the lookup join needs one row per key')
+    return index.get_indexer(query)
+
+
+# Combining part_id codes, electrode codes and bin_id into one integer key
+def encode_keys(part_code, electrode_code, bin_id, n_electrodes, n_bins):
+    return (part_code.astype(np.int64) * n_electrodes + electrode_code) * n_bins + bin_id
+
+
+def _codes(column, categories):
+    return pd.Categorical(column, categories=categories).codes.astype(np.int64)
+
+
+# Keeping the same rows in all position arrays
+def _keep(keep, *arrays):
+    return [array[keep] for array in arrays]
+
+
+# Naming the columns of a joined table as pd.merge does, adding suffixes to columns present on both sides
+def _suffixed(left, right, keys):
+    overlap = (set(left) & set(right)) - set(keys)
+    left = [column + '_x' if column in overlap else column for column in left]
+    right = [column + '_y' if column in overlap else column for column in right if column not in keys]
+    return left, right
+
+
+# Building the long table. data/baseline are ERPlab measurement exports, given as paths or as tables with the columns returned by
+# read_measurement (e.g. computed from an epoch store, see epoch_store.py), info the design matrix (with a bin_id column),
+# electrode the coordinates (with an electrode column) and elist_info an optional table keyed by part_id and bin_id.
+# info_index is the dense bin_id index of the design matrix (see design_matrix.py), built here when not given.
+# Rows are kept in the order of the ERP export. The inner merges this replaces give the same rows in another order with pandas
+# < 2.2 (grouped by the keys of each merge), so sort both tables before comparing them row by row. If audit is a list, the
+# number of rows before and after each join is appended to it
+def build_long_table(data, baseline, info, electrode, elist_info=None, drop_columns=(), info_index=None, audit=None):
+    data = _measurement(data, 'ERP')
+    baseline = _measurement(baseline, 'baseline')
+
+    # Encoding the keys of ERP and baseline on shared categories
+    part_ids = data['part_id'].cat.categories.union(baseline['part_id'].cat.categories)
+    electrodes = data['electrode'].cat.categories.union(baseline['electrode'].cat.categories)
+    n_bins = int(max(data['bin_id'].max(), baseline['bin_id'].max())) + 1
+    part_code = _codes(data['part_id'], part_ids)
+    electrode_code = _codes(data['electrode'], electrodes)
+    bin_id = data['bin_id'].to_numpy(dtype=np.int64)
+    baseline_pos = unique_lookup(
+        encode_keys(_codes(baseline['part_id'], part_ids), _codes(baseline['electrode'], electrodes),
+                    baseline['bin_id'].to_numpy(dtype=np.int64), len(electrodes), n_bins),
+        encode_keys(part_code, electrode_code, bin_id, len(electrodes), n_bins), 'baseline')
+
+    # Merging with baseline, then removing rows where both ERP and baseline are 0
+    rows = np.flatnonzero(baseline_pos >= 0)
+    if audit is not None:
+        audit.append({'step': 'baseline', 'rows_in': len(data), 'rows_out': len(rows)})
+    baseline_values = baseline['baseline'].to_numpy()[baseline_pos[rows]]
+    del baseline, baseline_pos
+    keep = (data['ERP'].to_numpy()[rows] != 0) | (baseline_values != 0)
+    if audit is not None:
+        audit.append({'step': 'ERP or baseline not 0', 'rows_in': len(keep), 'rows_out': int(keep.sum())})
+    rows, baseline_values = _keep(keep, rows, baseline_values)
+    part_code, electrode_code, bin_id = part_code[rows], electrode_code[rows], bin_id[rows]
+
+    # Merging with design matrix and electrode coordinates by lookup
+    if info_index is None:
+        info_index = dense_index(info['bin_id'])
+    info_pos = gather_index(info_index, bin_id)
+    coordinate_pos = unique_lookup(electrode['electrode'], electrodes, 'electrode coordinates')[electrode_code]
+    keep = (info_pos >= 0) & (coordinate_pos >= 0)
+    if audit is not None:
+        audit.append({'step': 'design matrix & electrode coordinates', 'rows_in': len(keep), 'rows_out': int(keep.sum())})
+    rows, baseline_values, part_code, bin_id, info_pos, coordinate_pos = _keep(
+        keep, rows, baseline_values, part_code, bin_id, info_pos, coordinate_pos)
+
+    # Merging with eventlist info on part_id & bin_id, ignoring participants without ERP data
+    if elist_info is not None:
+        elist_part_code = pd.Index(part_ids).get_indexer(elist_info['part_id'])
+        elist_rows = np.flatnonzero(elist_part_code >= 0)
+        elist_bin_id = elist_info['bin_id'].to_numpy(dtype=np.int64)[elist_rows]
+        n_bins = max(n_bins, int(elist_bin_id.max(initial=-1)) + 1)
+        elist_pos = unique_lookup(encode_keys(elist_part_code[elist_rows], 0, elist_bin_id, 1, n_bins),
+                                  encode_keys(part_code, 0, bin_id, 1, n_bins), 'eventlist info')
+        keep = elist_pos >= 0
+        if audit is not None:
+            audit.append({'step': 'eventlist info', 'rows_in': len(keep), 'rows_out': int(keep.sum())})
+        rows, baseline_values, info_pos, coordinate_pos, elist_pos = _keep(
+            keep, rows, baseline_values, info_pos, coordinate_pos, elist_pos)
+        elist_pos = elist_rows[elist_pos]
+    del part_code, bin_id
+
+    # Gathering each output column once, naming them as the chained merges did
+    info_columns = [column for column in info.columns if column != 'bin_id']
+    electrode_columns = [column for column in electrode.columns if column != 'electrode']
+    left_columns = list(data.columns) + ['baseline'] + info_columns + electrode_columns
+    if elist_info is not None:
+        left_columns, elist_columns = _suffixed(left_columns, list(elist_info.columns), ['part_id', 'bin_id'])
+    names = iter(left_columns)
+
+    long_table = {}
+    def gather(table, positions, columns):
+        for column in columns:
+            name = next(names)
+            if name not in drop_columns:
+                long_table[name] = table[column].take(positions).reset_index(drop=True)
+
+    gather(data, rows, data.columns)
+    del data
+    baseline_name = next(names)
+    if baseline_name not in drop_columns:
+        long_table[baseline_name] = pd.Series(baseline_values)
+    del baseline_values
+    gather(info, info_pos, info_columns)
+    gather(electrode, coordinate_pos, electrode_columns)
+    if elist_info is not None:
+        names = iter(elist_columns)
+        gather(elist_info, elist_pos, [column for column in elist_info.columns if column not in ('part_id', 'bin_id')])
+    return pd.DataFrame(long_table)
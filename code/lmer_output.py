@@ -0,0 +1,98 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module writes and reads the long tables used in the LMER analysis (e.g. lmer/300-500_info).
+# Besides the original csv, the table can be written as a columnar dataset (Parquet or Feather/Arrow IPC), partitioned by mode and
+# participant (300-500_info/mode=audio/part_id=part1/...). Dtypes are kept and readers can load only the columns and participants
+# they need, e.g. in R: arrow::open_dataset(path) %>% filter(part_id %in% c('part1', 'part2')) %>% select(ERP, baseline) %>% collect()
+# The columnar formats need pyarrow, which is only imported when they are used.
+
+################################################################
+
+import os
+
+import pandas as pd
+
+FORMATS = ('csv', 'parquet', 'feather')
+PARTITION_COLUMNS = ['mode', 'part_id']
+COMPRESSION = {'parquet': 'zstd', 'feather': 'lz4'} # lz4 keeps feather fast to write and read
+
+# First bytes of the files of each columnar format (Feather v2 files are Arrow IPC files)
+MAGIC_BYTES = {b'PAR1': 'parquet', b'ARROW1': 'feather'}
+
+
+def _dataset_format(output_format):
+    # Feather v2 files are Arrow IPC files
+    return 'ipc' if output_format == 'feather' else output_format
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError('pyarrow is needed for parquet/feather output, install it or use the csv format')
+    return pyarrow
+
+
+# Writing a long table. path is given without extension: csv goes to path.csv (as before), parquet/feather to the directory path/
+def write_long_table(table, path, output_format='csv', mode=None):
+    if output_format not in FORMATS:
+        raise ValueError('Unknown output format ' + str(output_format) + ', use one of ' + ', '.join(FORMATS))
+    if output_format == 'csv':
+        table.to_csv(path + '.csv')
+        return path + '.csv'
+
+    pyarrow = _import_pyarrow()
+    file_format = pyarrow.dataset.ParquetFileFormat() if output_format == 'parquet' else pyarrow.dataset.IpcFileFormat()
+    table = table.assign(mode=mode).astype({'mode': 'category', 'part_id': 'category'})
+    pyarrow.dataset.write_dataset(
+        pyarrow.Table.from_pandas(table, preserve_index=False), path,
+        format=file_format, file_options=file_format.make_write_options(compression=COMPRESSION[output_format]),
+        partitioning=PARTITION_COLUMNS, partitioning_flavor='hive',
+        existing_data_behavior='delete_matching') # rewriting a participant replaces its old files
+    return path
+
+
+# Format of a dataset written by write_long_table, from the first bytes of one of its files
+def dataset_format(path):
+    for folder, _, files in os.walk(path):
+        for name in sorted(files):
+            with open(os.path.join(folder, name), 'rb') as f:
+                start = f.read(6)
+            for magic, output_format in MAGIC_BYTES.items():
+                if start.startswith(magic):
+                    return output_format
+    raise ValueError('No parquet or feather file found in ' + path)
+
+
+# Reading a long table written by write_long_table, optionally only some columns, participants or modes. Without output_format,
+# a path ending in .csv is read as csv and a directory in the format of its files
+def read_long_table(path, output_format=None, columns=None, part_ids=None, modes=None):
+    if output_format is None:
+        output_format = 'csv' if path.endswith('.csv') else dataset_format(path)
+    if output_format == 'csv':
+        table = pd.read_csv(path, index_col=0, low_memory=False)
+        if part_ids is not None:
+            table = table[table['part_id'].isin(part_ids)]
+        return table if columns is None else table[columns]
+
+    pyarrow = _import_pyarrow()
+    dataset = pyarrow.dataset.dataset(path, format=_dataset_format(output_format), partitioning='hive')
+    row_filter = None
+    for name, values in (('part_id', part_ids), ('mode', modes)):
+        if values is not None:
+            condition = pyarrow.dataset.field(name).isin(list(values))
+            row_filter = condition if row_filter is None else row_filter & condition
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+
+# Listing the participants stored in a partitioned long table without reading any data
+def list_participants(path):
+    participants = set()
+    for mode_dir in os.listdir(path):
+        if mode_dir.startswith('mode=') and os.path.isdir(os.path.join(path, mode_dir)):
+            participants.update(name[len('part_id='):] for name in os.listdir(os.path.join(path, mode_dir))
+                                if name.startswith('part_id='))
+    return sorted(participants)
@@ -0,0 +1,119 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module fits the mass-univariate regressions done so far in MATLAB LIMO: for each participant, one linear model per
+# channel x timepoint, with the word regressors of limo_regressors.py (surprisal, prominence, content words only...) as predictors.
+# All channel x timepoint models of a participant share the same design matrix, so they are fitted at once: X'Y is accumulated
+# in one pass over the memory-mapped epochs (see epoch_store.py), for all models together, and the normal equations of each model
+# are solved once for every channel x timepoint. Words with a NaN regressor (e.g. function words in the content regressors) and
+# epochs rejected after artifact rejection are left out of the model. Participants run in a process pool, and the second level is
+# a one-sample t-test of the betas across participants, as in LIMO.
+
+################################################################
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from design_matrix import lookup_rows
+from epoch_store import CHUNK_EPOCHS, open_participant
+from limo_regressors import REGRESSORS, compute_regressors
+
+# Models fitted by default: one per LIMO regressor, each with an intercept
+MODELS = {name: {name: regressor} for name, regressor in REGRESSORS.items()}
+
+# Design matrix and its bin index, handed to each worker process when it starts
+_info = None
+_info_index = None
+
+
+# Design matrix of a model (epochs x (1 + regressors)), with zero rows for the epochs left out, and the epochs kept.
+# Regressors are z-scored over the kept epochs unless zscore is False
+def model_design(events_info, regressors, good, zscore=True):
+    values = compute_regressors(events_info, regressors)
+    keep = np.asarray(good, dtype=bool) & ~np.isnan(values).any(axis=1)
+    values = values[keep]
+    if zscore and keep.any():
+        std = values.std(axis=0)
+        values = (values - values.mean(axis=0)) / np.where(std > 0, std, 1)
+    design = np.zeros((len(keep), values.shape[1] + 1))
+    design[keep, 0] = 1
+    design[keep, 1:] = values
+    return design, keep
+
+
+# Fitting the models of one participant for every channel x timepoint. epochs: epochs x channels x samples, designs: list of
+# (design, keep) as returned by model_design. Returns per model the betas (1 + regressors) x channels x samples, the R2 per
+# channel x sample and the number of epochs used
+def fit_participant(epochs, designs):
+    n_epochs, n_channels, n_samples = epochs.shape
+    stacked = np.hstack([design for design, _ in designs])
+    masks = np.stack([keep for _, keep in designs], axis=1).astype(float)
+
+    # One pass over the data for all models: X'Y and the sum of squares of the kept epochs
+    xty = np.zeros((stacked.shape[1], n_channels * n_samples))
+    yty = np.zeros((len(designs), n_channels * n_samples))
+    for start in range(0, n_epochs, CHUNK_EPOCHS):
+        y = np.asarray(epochs[start:start + CHUNK_EPOCHS], dtype=np.float64).reshape(-1, n_channels * n_samples)
+        xty += stacked[start:start + CHUNK_EPOCHS].T @ y
+        yty += masks[start:start + CHUNK_EPOCHS].T @ (y * y)
+
+    results = []
+    offset = 0
+    for model, (design, keep) in enumerate(designs):
+        model_xty = xty[offset:offset + design.shape[1]]
+        offset += design.shape[1]
+        n = int(keep.sum())
+        xtx = design.T @ design
+        try:
+            betas = np.linalg.solve(xtx, model_xty) # one factorisation for all channels x timepoints
+        except np.linalg.LinAlgError: # e.g. a regressor without variance
+            betas = np.linalg.pinv(xtx) @ model_xty
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sse = yty[model] - (betas * model_xty).sum(axis=0)
+            sst = yty[model] - model_xty[0] ** 2 / n
+            r2 = 1 - sse / sst
+        results.append({'betas': betas.reshape(-1, n_channels, n_samples), 'r2': r2.reshape(n_channels, n_samples), 'n': n})
+    return results
+
+
+# First level of one participant: the words of its epochs (by bin) with their design matrix rows, then all models fitted at once
+def first_level(store_path, part_id, info, info_index, models=MODELS, zscore=True):
+    epochs, bin_ids, good = open_participant(store_path, part_id)
+    events_info = lookup_rows(info, info_index, bin_ids)
+    designs = [model_design(events_info, regressors, good, zscore) for regressors in models.values()]
+    return dict(zip(models, fit_participant(epochs, designs)))
+
+
+def _init_worker(info, info_index):
+    global _info, _info_index
+    _info, _info_index = info, info_index
+
+
+def _first_level(part_id, store_path, models, zscore):
+    return first_level(store_path, part_id, _info, _info_index, models, zscore)
+
+
+# First level of a cohort in a process pool, as {part_id: {model: results}}. info/info_index are the design matrix and its bin
+# index (see design_matrix.py)
+def fit_cohort(store_path, part_ids, info, info_index, models=MODELS, zscore=True, workers=None):
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(info, info_index)) as pool:
+        results = pool.map(partial(_first_level, store_path=store_path, models=models, zscore=zscore), part_ids)
+        return dict(zip(part_ids, results))
+
+
+# Second level: one-sample t-test of the betas of each model across participants. Returns per model the mean betas, t values
+# and two-sided p values, (1 + regressors) x channels x samples, and the number of participants
+def second_level(cohort_results):
+    from scipy.stats import t as t_distribution
+    tmaps = {}
+    for model in next(iter(cohort_results.values())):
+        betas = np.stack([results[model]['betas'] for results in cohort_results.values()])
+        n = len(betas)
+        mean = betas.mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = mean / (betas.std(axis=0, ddof=1) / np.sqrt(n))
+        tmaps[model] = {'mean': mean, 't': t, 'p': 2 * t_distribution.sf(np.abs(t), n - 1), 'n': n}
+    return tmaps
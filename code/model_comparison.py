@@ -0,0 +1,359 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module runs the model comparisons of audio_lmer.R (base, main and interaction models for each surprisal model and each
+# dataset, compared with likelihood ratio tests and AIC) from a declarative list of formulas.
+# Formulas use the lme4 syntax for fixed effects and random intercepts, e.g. 'ERP ~ surprisal_gpt2 * ROI + baseline + (1|part_id)'.
+# Each dataset is encoded once for all its models (response, each fixed effect term as columns, random factors as codes). Its
+# rows are set by the columns filtered per dataset (dropna, by default the surprisal columns of preprocessing() in audio_lmer.R),
+# not by the formulas, so that all models of a dataset use the same rows whichever families are fitted together. Models are
+# fitted in a process pool, each worker receiving the encoded datasets once, and fitted results are cached on disk under a hash of
+# the formula and of the data the model uses: adding a surprisal model only fits its own models.
+# Models with random intercepts are fitted by maximum likelihood with lme4 (lmer_fit.R, run with Rscript: the models of
+# audio_lmer.R), or when R is not installed with statsmodels (MixedLM, imported only when needed; several random factors are
+# fitted as crossed variance components), which is only practical on small samples: larger datasets are refused before any fit.
+# Models without random intercepts are fitted by least squares. Likelihood ratio tests are only reported between converged fits.
+
+################################################################
+
+import hashlib
+import itertools
+import os
+import pickle
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from file_utils import atomic_write
+
+RANDOM_INTERCEPT = r'\(\s*1\s*\|\s*([^()|]+?)\s*\)'
+
+# Fixed effects and random intercepts of the models in audio_lmer.R (surprisal_comparison), without the surprisal predictor
+BASE_FORMULA = 'ERP ~ ROI + baseline + (1|part_id) + (1|passage_id) + (1|electrode)'
+
+# Columns filtered in preprocessing() of audio_lmer.R: rows with a missing or infinite value in any of them are dropped
+PREPROCESSING_COLUMNS = ['surprisal_prev', 'surprisal_2gram', 'surprisal_3gram', 'surprisal_4gram', 'surprisal_5gram',
+                         'surprisal_6gram', 'surprisal_bert', 'surprisal_gpt2']
+
+# Largest dataset fitted with statsmodels MixedLM, whose time and memory grow with rows x levels of the random factors (a 10000
+# row sample already takes about half a minute per model); larger datasets need lme4
+MIXED_ROW_LIMIT = 10000
+
+# Script fitting one mixed model with lme4
+LMER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lmer_fit.R')
+
+# Encoded datasets, handed to each worker process when it starts
+_encoded = None
+
+
+# Parsing a formula into its response, fixed effect terms (tuples of variables, a*b giving a, b and a:b), intercept and random
+# intercepts. Only random intercepts are supported
+def parse_formula(formula):
+    response, rhs = (side.strip() for side in formula.split('~'))
+    random = re.findall(RANDOM_INTERCEPT, rhs)
+    rhs = re.sub(RANDOM_INTERCEPT, '', rhs)
+    if '|' in rhs:
+        raise ValueError('Only random intercepts (1|factor) are supported: ' + formula)
+
+    intercept, terms = True, []
+    for part in rhs.split('+'):
+        part = part.strip()
+        if part in ('0', '-1'):
+            intercept = False
+        elif part and part != '1':
+            factors = [tuple(variable.strip() for variable in factor.split(':')) for factor in part.split('*')]
+            for size in range(1, len(factors) + 1):
+                for combination in itertools.combinations(factors, size):
+                    term = tuple(dict.fromkeys(variable for factor in combination for variable in factor))
+                    if set(term) not in [set(existing) for existing in terms]:
+                        terms.append(term)
+    return {'response': response, 'terms': terms, 'intercept': intercept, 'random': random}
+
+
+# Same formula written in one canonical way, so that reordered terms share their fit and cache entry
+def canonical_formula(formula):
+    parsed = parse_formula(formula)
+    terms = sorted(':'.join(sorted(term)) for term in parsed['terms'])
+    random = ['(1|' + factor + ')' for factor in sorted(parsed['random'])]
+    return parsed['response'] + ' ~ ' + ' + '.join(([] if parsed['intercept'] else ['0']) + terms + random)
+
+
+def _variables(parsed):
+    return [parsed['response']] + [variable for term in parsed['terms'] for variable in term] + parsed['random']
+
+
+def _hash(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+# Columns of one variable: numeric variables as they are, categorical ones in treatment coding (first level as reference)
+def _encode_variable(column):
+    if pd.api.types.is_numeric_dtype(column) and not isinstance(column.dtype, pd.CategoricalDtype):
+        return column.to_numpy(dtype=float)[:, None], [column.name]
+    categories = pd.Categorical(column)
+    codes = categories.codes
+    levels = list(categories.categories)
+    matrix = (codes[:, None] == np.arange(1, len(levels))[None, :]).astype(float)
+    return matrix, [str(column.name) + '[' + str(level) + ']' for level in levels[1:]]
+
+
+# Rows without a missing or infinite value in the columns
+def _complete_rows(table):
+    numeric = table.select_dtypes('number')
+    return table.notna().all(axis=1).to_numpy() & np.isfinite(numeric.to_numpy(dtype=float)).all(axis=1)
+
+
+# Encoding a dataset once for all the formulas fitted on it. Rows with a missing or infinite value in a dropna column are dropped
+# (as in preprocessing() in audio_lmer.R); the variables of the formulas must then be complete. Interactions are products of
+# the columns of their variables, so models should include the main effects of their interactions (as in audio_lmer.R)
+def encode_data(data, formulas, dropna=PREPROCESSING_COLUMNS):
+    parsed = [parse_formula(formula) for formula in formulas]
+    variables = list(dict.fromkeys(variable for model in parsed for variable in _variables(model)))
+    missing = [variable for variable in list(dict.fromkeys(list(dropna) + variables)) if variable not in data.columns]
+    if missing:
+        raise ValueError('Variables missing from the data: ' + ', '.join(missing))
+
+    table = data.loc[_complete_rows(data[list(dropna)]), variables].reset_index(drop=True)
+    incomplete = [variable for variable in variables if not _complete_rows(table[[variable]]).all()]
+    if incomplete:
+        raise ValueError('Missing or infinite values in ' + ', '.join(incomplete) + ', add them to dropna to leave out these rows')
+
+    encoded = {'n': len(table), 'variables': {}, 'hashes': {}, 'factors': {}, 'terms': {}}
+    for variable in variables:
+        encoded['variables'][variable] = _encode_variable(table[variable])
+        encoded['hashes'][variable] = _hash(encoded['variables'][variable][0])
+    for model in parsed:
+        for factor in model['random']:
+            codes, levels = pd.factorize(table[factor], sort=True)
+            encoded['factors'][factor] = (codes, list(levels))
+    return encoded
+
+
+# Columns of a fixed effect term, built once per dataset
+def _term_columns(encoded, term):
+    if term not in encoded['terms']:
+        matrix, names = encoded['variables'][term[0]]
+        for variable in term[1:]:
+            other, other_names = encoded['variables'][variable]
+            matrix = (matrix[:, :, None] * other[:, None, :]).reshape(len(matrix), -1)
+            names = [name + ':' + other_name for name in names for other_name in other_names]
+        encoded['terms'][term] = (matrix, names)
+    return encoded['terms'][term]
+
+
+# Fixed effect design matrix of a parsed formula, with its column names
+def model_matrix(encoded, parsed):
+    columns = [(np.ones((encoded['n'], 1)), ['(Intercept)'])] if parsed['intercept'] else []
+    columns += [_term_columns(encoded, term) for term in parsed['terms']]
+    if not columns:
+        return np.empty((encoded['n'], 0)), []
+    return np.hstack([matrix for matrix, _ in columns]), [name for _, names in columns for name in names]
+
+
+# Cache key of a model: its canonical formula, the fitting method and the hashes of the data it uses
+def model_key(encoded, formula, method):
+    parsed = parse_formula(formula)
+    used = sorted(set(_variables(parsed)))
+    content = [method, canonical_formula(formula), encoded['n']] + [(variable, encoded['hashes'][variable]) for variable in used]
+    return hashlib.sha1(repr(content).encode()).hexdigest()
+
+
+# Least squares fit by maximum likelihood (no random effects)
+def fit_ols(y, X, names):
+    coefficients, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+    sse = float(((y - X @ coefficients) ** 2).sum())
+    n = len(y)
+    return {'logLik': -n / 2 * (np.log(2 * np.pi) + np.log(sse / n) + 1), 'df': rank + 1, 'converged': True,
+            'coefficients': pd.Series(coefficients, index=names)}
+
+
+# Mixed model fit by maximum likelihood with lme4, in lmer_fit.R. The encoded columns are handed over as they are, so that both
+# backends fit the same design matrix
+def fit_lme4(y, X, names, factors):
+    rscript = shutil.which('Rscript')
+    if rscript is None:
+        raise ImportError('Rscript (R with lme4) is needed for method lme4, install R or use method mixed on small datasets')
+
+    table = pd.DataFrame(X, columns=['x' + str(i) for i in range(X.shape[1])])
+    table.insert(0, 'y', y)
+    for i, (codes, _) in enumerate(factors.values()):
+        table['f' + str(i)] = codes
+    with tempfile.TemporaryDirectory() as folder:
+        table.to_csv(os.path.join(folder, 'data.csv'), index=False)
+        fit = subprocess.run([rscript, LMER_SCRIPT, os.path.join(folder, 'data.csv'), os.path.join(folder, 'result.csv')],
+                             capture_output=True, text=True)
+        if fit.returncode != 0:
+            raise RuntimeError('lme4 fit failed: ' + fit.stderr.strip())
+        result = pd.read_csv(os.path.join(folder, 'result.csv'), index_col='name')['value']
+    return {'logLik': float(result['logLik']), 'df': int(result['df']), 'converged': bool(result['converged']),
+            'coefficients': pd.Series(result.iloc[3:].to_numpy(dtype=float), index=names)}
+
+
+# Mixed model fit by maximum likelihood with statsmodels. One random factor is fitted as groups, several as crossed variance
+# components within a single group, with sparse indicator matrices (one non-zero per row, as use_sparse in MixedLM.from_formula).
+# The score and Hessian of statsmodels still hold dense n x levels arrays, so datasets above MIXED_ROW_LIMIT rows are refused
+def fit_mixed(y, X, names, factors):
+    _check_mixed_rows(len(y))
+    try:
+        from statsmodels.regression.mixed_linear_model import MixedLM, VCSpec
+    except ImportError:
+        raise ImportError('statsmodels is needed for models with random effects, install it or fit them in R (audio_lmer.R)')
+
+    if len(factors) == 1:
+        codes, _ = next(iter(factors.values()))
+        model = MixedLM(y, X, groups=codes)
+    else:
+        from scipy import sparse
+        vc_names = list(factors)
+        colnames = [[[str(level) for level in levels]] for _, levels in factors.values()]
+        mats = [[sparse.csr_array((np.ones(len(codes)), (np.arange(len(codes)), codes)), shape=(len(codes), len(levels)))]
+                for codes, levels in factors.values()]
+        model = MixedLM(y, X, groups=np.zeros(len(y)), exog_vc=VCSpec(vc_names, colnames, mats))
+    result = model.fit(reml=False)
+    return {'logLik': float(result.llf), 'df': X.shape[1] + len(factors) + 1, 'converged': bool(result.converged),
+            'coefficients': pd.Series(np.asarray(result.fe_params), index=names)}
+
+
+def _check_mixed_rows(n, dataset=None):
+    if n > MIXED_ROW_LIMIT:
+        raise ValueError(('Dataset ' + dataset + ' has ' if dataset else 'The data have ') + str(n) + ' rows, more than '
+                         + str(MIXED_ROW_LIMIT) + ' (MIXED_ROW_LIMIT) for statsmodels: install R with lme4 (method lme4) or '
+                         'fit a sample of the rows')
+
+
+# Backend of the mixed models for method 'auto': lme4 when Rscript is installed, statsmodels otherwise
+def _resolve_method(method):
+    if method == 'auto':
+        return 'lme4' if shutil.which('Rscript') is not None else 'mixed'
+    return method
+
+
+# Fitting one formula on an encoded dataset. Formulas with random intercepts are fitted as mixed models with method 'lme4' or
+# 'mixed' (statsmodels), or 'auto' (lme4 when R is installed); other methods, and formulas without, by least squares
+def fit_model(encoded, formula, method='auto'):
+    parsed = parse_formula(formula)
+    y = encoded['variables'][parsed['response']][0][:, 0]
+    X, names = model_matrix(encoded, parsed)
+    method = _resolve_method(method)
+    factors = {factor: encoded['factors'][factor] for factor in parsed['random']}
+    if parsed['random'] and method == 'lme4':
+        result = fit_lme4(y, X, names, factors)
+    elif parsed['random'] and method == 'mixed':
+        result = fit_mixed(y, X, names, factors)
+    else:
+        result = fit_ols(y, X, names)
+    result.update({'formula': formula, 'n': encoded['n']})
+    return result
+
+
+def _init_worker(encoded):
+    global _encoded
+    _encoded = encoded
+
+
+def _fit(task):
+    dataset, formula, method = task
+    return fit_model(_encoded[dataset], formula, method)
+
+
+def _read_cache(cache_path, key):
+    if cache_path is not None and os.path.exists(os.path.join(cache_path, key + '.pkl')):
+        with open(os.path.join(cache_path, key + '.pkl'), 'rb') as f:
+            return pickle.load(f)
+    return None
+
+
+def _write_cache(cache_path, key, result):
+    os.makedirs(cache_path, exist_ok=True)
+    with atomic_write(os.path.join(cache_path, key + '.pkl')) as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# Model families of audio_lmer.R: for each surprisal predictor, the base model, the main effect model and the interaction model
+def surprisal_families(predictors, base=BASE_FORMULA, interaction='ROI'):
+    return {predictor: {'base': base,
+                        'main': base + ' + ' + predictor,
+                        'interaction': base + ' + ' + predictor + ' * ' + interaction}
+            for predictor in predictors}
+
+
+# Benjamini-Hochberg adjusted p values, NaN left out (p.adjust(method = 'fdr') in R)
+def fdr(p):
+    p = np.asarray(p, dtype=float)
+    adjusted = np.full(len(p), np.nan)
+    tested = np.flatnonzero(~np.isnan(p))
+    order = tested[np.argsort(p[tested])]
+    ranked = p[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+
+# Fitting every model of every family on every dataset and comparing them. datasets: name -> table (e.g. read with
+# lmer_output.read_long_table), families: name -> {label: formula}, nested models from the simplest. dropna: columns whose
+# missing or infinite values leave out a row, for all datasets or per dataset (name -> columns). Identical models (e.g. the
+# base model shared by all families) are fitted once, and fits found in cache_path are not repeated. Returns one row per
+# dataset x family x model with its log likelihood, AIC, BIC, the likelihood ratio test against the previous model of the
+# family (p_fdr adjusted per dataset) and aic_dif, the AIC reduction from the first model of the family. The test is left
+# empty (and out of the FDR correction) when either fit did not converge, as their likelihoods cannot be compared
+def compare_models(datasets, families, method='auto', cache_path=None, workers=None, dropna=PREPROCESSING_COLUMNS):
+    formulas = list(dict.fromkeys(formula for family in families.values() for formula in family.values()))
+    encoded = {name: encode_data(data, formulas, dropna[name] if isinstance(dropna, dict) else dropna)
+               for name, data in datasets.items()}
+    method = _resolve_method(method)
+
+    keys, results, tasks = {}, {}, {}
+    for dataset in datasets:
+        for formula in formulas:
+            key = model_key(encoded[dataset], formula, method)
+            keys[dataset, formula] = key
+            if key not in results:
+                cached = _read_cache(cache_path, key)
+                if cached is not None:
+                    results[key] = cached
+                elif key not in tasks:
+                    tasks[key] = (dataset, formula, method)
+
+    if method == 'mixed': # refused before any fit starts
+        for dataset, formula, _ in tasks.values():
+            if parse_formula(formula)['random']:
+                _check_mixed_rows(encoded[dataset]['n'], dataset)
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(encoded,)) as pool:
+            for key, result in zip(tasks, pool.map(_fit, tasks.values())):
+                results[key] = result
+                if cache_path is not None:
+                    _write_cache(cache_path, key, result)
+
+    rows = []
+    for dataset in datasets:
+        for family, models in families.items():
+            previous = first = None
+            for label, formula in models.items():
+                result = results[keys[dataset, formula]]
+                row = {'dataset': dataset, 'family': family, 'model': label, 'formula': formula, 'n': result['n'],
+                       'df': result['df'], 'logLik': result['logLik'], 'converged': result['converged']}
+                row['AIC'] = 2 * row['df'] - 2 * row['logLik']
+                row['BIC'] = np.log(row['n']) * row['df'] - 2 * row['logLik']
+                row['deviance'] = -2 * row['logLik']
+                row['Chisq'], row['Chi_Df'], row['p'] = np.nan, np.nan, np.nan
+                if previous is not None and row['df'] > previous['df'] and row['converged'] and previous['converged']:
+                    row['Chisq'] = 2 * (row['logLik'] - previous['logLik'])
+                    row['Chi_Df'] = row['df'] - previous['df']
+                first = first or row
+                row['aic_dif'] = first['AIC'] - row['AIC']
+                rows.append(row)
+                previous = row
+
+    table = pd.DataFrame(rows)
+    tested = table['Chi_Df'].notna()
+    if tested.any():
+        from scipy.stats import chi2
+        table.loc[tested, 'p'] = chi2.sf(table.loc[tested, 'Chisq'], table.loc[tested, 'Chi_Df'])
+    table['p_fdr'] = table.groupby('dataset')['p'].transform(lambda p: pd.Series(fdr(p), index=p.index))
+    return table
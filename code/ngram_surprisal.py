@@ -0,0 +1,235 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module computes n-gram surprisal (surprisal_2gram ... surprisal_6gram in the design matrices) from a local text corpus,
+# instead of bringing it in from the *_sentenceInfo_log_probs.csv files of an external tool.
+# The corpus (one sentence per line) is read once into an array of word ids, and the n-grams of every order are counted into a
+# trie stored as arrays: the n-grams of order n are sorted by key = (node of their first n-1 words) * vocabulary size + last
+# word, so that the node of an n-gram is its position in that sorted array and a lookup is a binary search. The index only
+# holds counts, it is cached on disk by corpus hash and maximum order, so that smoothing settings can be changed without
+# counting again.
+# Probabilities use interpolated Kneser-Ney smoothing (or interpolated absolute discounting), with the discount of each order
+# estimated from its counts of counts. The stimulus words are scored for all orders in one pass: the lower order distributions
+# are shared, and each order only adds its own level. Surprisal is -log2 probability, with the context running over the words of
+# each sentence_id from a sentence start.
+
+################################################################
+
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+from file_utils import atomic_write, content_hash
+from surprisal_alignment import normalize_words
+
+BOS, EOS = '<s>', '</s>' # sentence start and end, word ids 0 and 1
+SMOOTHING = ('kneser_ney', 'absolute')
+CHUNK_LINES = 100000 # corpus lines tokenised at once
+
+
+# Reading a corpus (one sentence per line, words separated by spaces) as one array of word ids, each sentence between <s> and
+# </s>. Words are normalised as in surprisal_alignment.py (lower case, punctuation removed). Returns the ids and the vocabulary
+def read_corpus(path, chunk_lines=CHUNK_LINES):
+    vocabulary = {BOS: 0, EOS: 1}
+    streams = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_lines))
+            if not lines:
+                break
+            words = pd.Series(lines).str.split().explode()
+            normalized = normalize_words(words.to_numpy())
+            kept = normalized != ''
+            codes, uniques = pd.factorize(normalized[kept])
+            ids = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in uniques], dtype=np.int32)[codes]
+
+            # Positions of the words in the stream of the chunk, leaving a place for <s> and </s> around each sentence
+            line_of_word = words.index.to_numpy()[kept]
+            lengths = np.bincount(line_of_word, minlength=len(lines))
+            lines_kept = lengths > 0
+            starts = np.concatenate([[0], np.cumsum(lengths[lines_kept] + 2)])
+            line_start = np.zeros(len(lines), dtype=np.int64)
+            line_start[lines_kept] = starts[:-1]
+            first_word = np.concatenate([[0], np.cumsum(lengths)])[:-1]
+            rank = np.arange(len(ids)) - first_word[line_of_word]
+
+            stream = np.empty(starts[-1], dtype=np.int32)
+            stream[starts[:-1]] = 0
+            stream[starts[1:] - 1] = 1
+            stream[line_start[line_of_word] + 1 + rank] = ids
+            streams.append(stream)
+    return np.concatenate(streams) if streams else np.empty(0, dtype=np.int32), list(vocabulary)
+
+
+# Position of the <s> of the sentence of each position of a word id stream
+def _sentence_start(stream):
+    return np.maximum.accumulate(np.where(stream == 0, np.arange(len(stream)), 0))
+
+
+# Counting the n-grams of every order up to max_order in one array trie. Level n holds the sorted keys of the n-grams of order n
+# (node of the first n-1 words * vocabulary size + last word) and their counts. Below max_order, each level also holds the
+# continuation counts (number of different words seen before the n-gram), used by Kneser-Ney smoothing
+def count_ngrams(stream, vocabulary_size, max_order=6):
+    start = _sentence_start(stream)
+    positions = np.arange(len(stream))
+    nodes = stream.astype(np.int64) # node of the n-gram ending at each position, -1 where it would cross a sentence start
+    levels = [{'keys': np.arange(vocabulary_size, dtype=np.int64),
+               'counts': np.bincount(stream, minlength=vocabulary_size).astype(np.int64)}]
+    for order in range(2, max_order + 1):
+        ends = np.flatnonzero(positions - order + 1 >= start)
+        keys = nodes[ends - 1] * vocabulary_size + stream[ends]
+        unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        suffix = np.empty(len(unique_keys), dtype=np.int64) # node of the last order-1 words of each n-gram
+        suffix[inverse] = nodes[ends]
+        levels[-1]['continuation'] = np.bincount(suffix, minlength=len(levels[-1]['keys'])).astype(np.int64)
+        levels.append({'keys': unique_keys, 'counts': counts.astype(np.int64)})
+        nodes = np.full(len(stream), -1, dtype=np.int64)
+        nodes[ends] = inverse
+    return levels
+
+
+# Count index of a corpus, read from cache_path when the corpus was already counted up to max_order
+def build_index(corpus_path, max_order=6, cache_path=None):
+    cache_file = None
+    if cache_path is not None:
+        cache_file = os.path.join(cache_path, 'ngram_' + content_hash(corpus_path) + '_' + str(max_order) + '.npz')
+        if os.path.exists(cache_file):
+            with np.load(cache_file, allow_pickle=False) as arrays:
+                levels = [{name: arrays[str(order) + '_' + name] for name in ('keys', 'counts', 'continuation')
+                           if str(order) + '_' + name in arrays} for order in range(1, max_order + 1)]
+                return {'vocabulary': list(arrays['vocabulary']), 'levels': levels}
+
+    stream, vocabulary = read_corpus(corpus_path)
+    index = {'vocabulary': vocabulary, 'levels': count_ngrams(stream, len(vocabulary), max_order)}
+    if cache_file is not None:
+        os.makedirs(cache_path, exist_ok=True)
+        arrays = {str(order) + '_' + name: array for order, level in enumerate(index['levels'], 1) for name, array in level.items()}
+        with atomic_write(cache_file) as f:
+            np.savez(f, vocabulary=np.array(vocabulary), **arrays)
+    return index
+
+
+# Discount of an order from its counts of counts (Ney et al., 1994)
+def _discount(counts):
+    n1, n2 = np.count_nonzero(counts == 1), np.count_nonzero(counts == 2)
+    return n1 / (n1 + 2 * n2) if n1 and n2 else 0.5
+
+
+# Node of each (parent node, word) in a level, -1 where the n-gram is not in the corpus
+def _lookup(keys, parents, words, vocabulary_size):
+    query = parents * vocabulary_size + words
+    if not len(keys):
+        return np.full(len(query), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where((parents >= 0) & (words >= 0) & (keys[positions] == query), positions, -1)
+
+
+# Interpolating the probability of an order with the lower order one. context: node of the context in the level below (-1 if
+# unseen, then only the lower order is used), ngram: node of the n-gram in this level
+def _interpolate(counts, keys, vocabulary_size, n_contexts, discount, context, ngram, lower):
+    parents = keys // vocabulary_size
+    totals = np.bincount(parents, weights=counts, minlength=n_contexts)
+    types = np.bincount(parents, minlength=n_contexts)
+    seen = context >= 0
+    total = np.where(seen, totals[np.maximum(context, 0)], 0)
+    seen &= total > 0
+    total = np.where(seen, total, 1)
+    count = np.where(ngram >= 0, counts[np.maximum(ngram, 0)], 0)
+    interpolated = (np.maximum(count - discount, 0) + discount * types[np.maximum(context, 0)] * lower) / total
+    return np.where(seen, interpolated, lower)
+
+
+# Word ids of words, -1 for words that are not in the corpus
+def word_ids(index, words):
+    vocabulary = pd.Index(index['vocabulary'])
+    return vocabulary.get_indexer(words).astype(np.int64)
+
+
+# Probability of each word of a word id stream (sentences starting with id 0, <s>) for every order from 2 to the index order.
+# Returns order -> probabilities (NaN at the <s> positions)
+def stream_probabilities(index, stream, smoothing='kneser_ney', discounts=None):
+    if smoothing not in SMOOTHING:
+        raise ValueError('Unknown smoothing ' + str(smoothing) + ', use one of ' + ', '.join(SMOOTHING))
+    levels = index['levels']
+    vocabulary_size = len(index['vocabulary'])
+    start = _sentence_start(stream)
+    positions = np.arange(len(stream))
+
+    # Lower orders use continuation counts with Kneser-Ney (raw counts for n-grams starting with <s>, never continued)
+    def lower_counts(level):
+        if smoothing == 'absolute' or 'continuation' not in level:
+            return level['counts']
+        return np.where(level['continuation'] > 0, level['continuation'], level['counts'])
+
+    def discount(order, counts):
+        return discounts[order] if discounts is not None and order in discounts else _discount(counts)
+
+    # Unigram distribution, with a share of the discounted mass spread over the vocabulary (also given to unknown words)
+    unigram = lower_counts(levels[0]).astype(float)
+    unigram[0] = 0 # <s> is never predicted
+    unigram_discount = discount(1, unigram[unigram > 0])
+    word = np.where(stream == 0, -1, stream)
+    count = np.where(word >= 0, unigram[np.maximum(word, 0)], 0)
+    lower = (np.maximum(count - unigram_discount, 0)
+             + unigram_discount * np.count_nonzero(unigram) / (vocabulary_size - 1)) / unigram.sum()
+
+    nodes = np.where(stream >= 0, stream, -1)
+    probabilities = {}
+    for order in range(2, len(levels) + 1):
+        level = levels[order - 1]
+        context = np.full(len(stream), -1, dtype=np.int64)
+        inside = positions - order + 1 >= start
+        context[1:] = np.where(inside[1:], nodes[:-1], -1)
+        ngram = _lookup(level['keys'], context, stream, vocabulary_size)
+        n_contexts = len(levels[order - 2]['keys'])
+
+        highest = level['counts']
+        probabilities[order] = np.where(stream == 0, np.nan, _interpolate(
+            highest, level['keys'], vocabulary_size, n_contexts, discount(order, highest), context, ngram, lower))
+        if order < len(levels):
+            counts = lower_counts(level)
+            lower = _interpolate(counts, level['keys'], vocabulary_size, n_contexts, discount(order, counts), context, ngram,
+                                 lower)
+        nodes = ngram
+    return probabilities
+
+
+# Adding n-gram surprisal to a design matrix, as surprisal_2gram ... surprisal_<max>gram. Words are scored in word_column
+# order within each group (sentence_id), each group starting from a sentence start. Words that are only punctuation get NaN
+def score_design_matrix(design, index, group_column='sentence_id', order_column='word_sequence', word_column='word',
+                        smoothing='kneser_ney', discounts=None, min_order=2, base=2):
+    design = design.copy()
+    ordered = design.reset_index(drop=True).sort_values([group_column, order_column], kind='stable')
+    words = normalize_words(ordered[word_column])
+    rows = ordered.index.to_numpy()[words != '']
+    groups = ordered[group_column].to_numpy()[words != '']
+    ids = word_ids(index, words[words != ''])
+
+    # Word ids of the stream, with a sentence start before each group
+    new_group = np.ones(len(ids), dtype=bool)
+    new_group[1:] = groups[1:] != groups[:-1]
+    word_positions = np.arange(len(ids)) + np.cumsum(new_group)
+    stream = np.zeros(len(ids) + new_group.sum(), dtype=np.int64)
+    stream[word_positions] = ids
+
+    for order, probabilities in stream_probabilities(index, stream, smoothing, discounts).items():
+        if order >= min_order:
+            surprisal = np.full(len(design), np.nan)
+            surprisal[rows] = -np.log(probabilities[word_positions]) / np.log(base)
+            design['surprisal_' + str(order) + 'gram'] = surprisal
+    return design
+
+
+if __name__ == '__main__':
+    # Scoring the words of a design matrix with a local corpus. The new surprisal replaces surprisal_2gram ... surprisal_6gram
+    stimuli_path = '/Users/yezhang/OneDrive - University College London/surprisal_audio/stimuli/'
+    corpus_path = stimuli_path + 'corpus/corpus.txt'
+    design_path = stimuli_path + 'word_merged_audio_seq.csv'
+    output_path = stimuli_path + 'word_merged_audio_seq_local_ngram.csv'
+
+    index = build_index(corpus_path, max_order=6, cache_path=stimuli_path + 'corpus/cache/')
+    design = pd.read_csv(design_path, index_col=0)
+    score_design_matrix(design, index, smoothing='kneser_ney').to_csv(output_path)
@@ -0,0 +1,402 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This script runs the Python stages of the preprocessing from one configuration file, instead of editing mode and paths in each
+# script: design_matrix (supplementary_scripts/surprisal_audio_design_matrix.py), eventlist (preprocessing_generate_eventlist.py),
+# variables (preprocessing_variables.py) and limo (supplementary_scripts/LIMO_variables.py).
+# Each stage declares its units of work (one per participant, or the whole stage for the design matrix) and their input files.
+# Inputs are hashed by content (file hashes are reused while size and modification time are unchanged; for the ERPlab exports,
+# which hold all participants, the rows of each participant are hashed when the export changed) together with the stage settings,
+# and only the units whose hash changed, or whose outputs are missing, are run again. Participants run in a process pool, and the
+# csv of the variables stage is joined from one fragment per participant, so that only the participants run are written again.
+# For every unit the state file keeps the wall time, the peak memory (Python and NumPy allocations, traced with tracemalloc) and
+# the number of rows before and after each merge, so that rows silently lost in a join show in the report.
+#
+# Usage: python pipeline.py config.json [--stages variables limo] [--force] [--workers 4]
+# config.json has one section per stage to run, e.g.
+# {"state_path": ".../pipeline_state.json",
+#  "design_matrix": {"folders": [".../GestureAudio/", ".../NoGestureAudio/"], "word_info": ".../WordMerged_total.csv",
+#                    "output": ".../stimuli/word_merged_audio.parquet"},
+#  "eventlist": {"path": ".../data/preprocessing/", "design_matrix": ".../stimuli/word_merged_audio.xlsx", "part_num": 25},
+#  "variables": {"mode": "audio", "path": ".../data_audio/", "sources": {"audio_seq": ".../word_merged_audio_seq.csv"},
+#                "coordinates": ".../channel_coordinate.csv", "window": [300, 500], "part_num": 25},
+#  "limo": {"mode": "limo_video", "path": ".../data_video", "sources": {"audio": ".../word_merged_audio.xlsx"}, "part_num": 31}}
+# Optional settings: variables epoch_store_path, rois (list of names in electrode_roi.ROIS, or name -> electrodes) and
+# output_format ('csv', 'parquet', 'feather'), limo output_format ('txt', 'npy', 'mat'), design_matrix excel, part_ids instead
+# of part_num
+
+################################################################
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import pandas as pd
+
+import limo_regressors
+import preprocessing_generate_eventlist
+from design_matrix import design_matrix, load_store
+from electrode_roi import ROIS, read_coordinates
+from file_utils import atomic_write, content_hash
+from lmer_join import read_measurement
+from lmer_output import write_long_table
+from preprocessing_variables import eventlist_info, eventlist_path, export_paths, output_name, read_amplitudes, variables_table
+from prosody_ingestion import build_design_matrix, prominence_files, write_design_matrix
+
+# Stages in the order of the preprocessing. No stage reads the output of another one: the eventlist, variables and limo stages
+# read the stimulus tables of their section (e.g. word_merged_audio.xlsx, with bin_id), not the prosody table written by the
+# design_matrix stage (bin_id_new/bin_id_old)
+STAGES = ['design_matrix', 'eventlist', 'variables', 'limo']
+
+# Settings shared by the units of a stage (design matrix, electrode coordinates...), set in each worker process when it starts
+_shared = None
+
+# Peak traced memory of the running unit before its tracing was paused
+_paused_peak = 0
+
+
+# Hash of a file content. memo holds the hash of files already read, reused while their size and modification time are unchanged
+def file_hash(path, memo):
+    if not os.path.exists(path):
+        raise FileNotFoundError('Input of the pipeline not found: ' + path)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    path = os.path.abspath(path)
+    if path in memo and memo[path][:2] == signature:
+        return memo[path][2]
+    memo[path] = signature + [content_hash(path)]
+    return memo[path][2]
+
+
+# Hash of the rows of a table
+def table_hash(table):
+    return hashlib.sha1(pd.util.hash_pandas_object(table, index=False).to_numpy().tobytes()).hexdigest()
+
+
+# Hash of a unit: the stage settings (except the list of participants, so that adding one does not run the others again) and
+# the hashes of its inputs
+def _unit_hash(section, *inputs):
+    settings = {name: value for name, value in section.items() if name not in ('part_ids', 'part_num')}
+    return hashlib.sha1(json.dumps([settings, inputs], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def part_ids(section):
+    if 'part_ids' in section:
+        return list(section['part_ids'])
+    return ['part' + str(i) for i in range(1, section['part_num'] + 1)]
+
+
+def _rois(section):
+    rois = section.get('rois')
+    return {name: ROIS[name] for name in rois} if isinstance(rois, list) else rois
+
+
+# Design matrix stage: one unit, inputs are the prominence files and WordMerged_total.csv
+def design_matrix_units(section, memo, context):
+    inputs = [file_hash(path, memo) for _, path in prominence_files(section['folders'])]
+    return {'all': _unit_hash(section, inputs, file_hash(section['word_info'], memo))}
+
+
+def design_matrix_unit(section, unit, payload, audit):
+    table = build_design_matrix(section['folders'], section['word_info'], audit=audit)
+    return [write_design_matrix(table, section['output'], section.get('excel'))]
+
+
+# Eventlist stage: one unit per participant, inputs are the original eventlist, the two Presentation logs and the design matrix
+def eventlist_units(section, memo, context):
+    path = section['path']
+    shared = file_hash(section['design_matrix'], memo)
+    return {part_id: _unit_hash(section, shared, [file_hash(input_path, memo) for input_path in (
+                path + 'eventlist/original/eventlist_' + part_id + '.txt', path + 'log/' + part_id + '_a.log',
+                path + 'log/' + part_id + '_b.log')])
+            for part_id in part_ids(section)}
+
+
+def eventlist_shared(section, units):
+    return preprocessing_generate_eventlist.load_word_onsets(section['design_matrix'])
+
+
+def eventlist_unit(section, part_id, payload, audit):
+    return [preprocessing_generate_eventlist.write_eventlist(part_id, section['path'], audit, info_onset=_shared)]
+
+
+# Variables stage: one unit per participant, inputs are its rows in the ERPlab exports (or its epochs in the epoch store) and its
+# eventlist exported after artifact rejection, with the design matrix and the electrode coordinates
+def _variables_design(section):
+    return design_matrix(load_store(section['sources'], section['path'] + 'design_matrix.pkl'), section['mode'])
+
+
+# Hashes of the rows of each participant in an ERPlab export. They are kept in memo with the hash of the export, which is only
+# read again when it changed (the participants read are kept in context for the units to run)
+def participant_hashes(path, value_name, memo, context):
+    key = os.path.abspath(path) + ':participants'
+    export_hash = file_hash(path, memo)
+    if key in memo and memo[key][0] == export_hash:
+        return memo[key][1]
+    context[value_name] = dict(tuple(read_measurement(path, value_name).groupby('part_id', observed=True)))
+    memo[key] = [export_hash, {part_id: table_hash(rows) for part_id, rows in context[value_name].items()}]
+    return memo[key][1]
+
+
+def variables_units(section, memo, context):
+    shared = [file_hash(path, memo) for path in section['sources'].values()] + [file_hash(section['coordinates'], memo)]
+    if section.get('epoch_store_path') is None:
+        hashes = {name: participant_hashes(path, name, memo, context)
+                  for name, path in export_paths(section['path'], section['window']).items()}
+    units = {}
+    for part_id in part_ids(section):
+        if section.get('epoch_store_path') is None:
+            inputs = [hashes[name].get(part_id, 'missing') for name in ('ERP', 'baseline')]
+        else:
+            inputs = [file_hash(os.path.join(section['epoch_store_path'], part_id + suffix), memo)
+                      for suffix in ('.npy', '_bins.npy', '_good.npy')]
+        if section['mode'] in ('audio', 'video'):
+            inputs.append(file_hash(eventlist_path(section['path'], part_id), memo))
+        units[part_id] = _unit_hash(section, shared, inputs)
+    return units
+
+
+def variables_shared(section, units):
+    info, info_index = _variables_design(section)
+    return {'info': info, 'info_index': info_index, 'electrode': read_coordinates(section['coordinates'])}
+
+
+# Amplitudes of the participants to run, sent with their unit (the exports are read here if they were not read for the hashes).
+# Participants without rows in an export are reported before any unit runs
+def variables_payloads(section, units, context):
+    if section.get('epoch_store_path') is None:
+        missing = []
+        for name, path in export_paths(section['path'], section['window']).items():
+            if name not in context:
+                context[name] = dict(tuple(read_measurement(path, name).groupby('part_id', observed=True)))
+            missing += [part_id + ' in ' + path for part_id in units if part_id not in context[name]]
+        if missing:
+            raise ValueError('No rows in the ERPlab export for ' + ', '.join(missing) + ', export them or leave them out of part_ids')
+        return {part_id: (context['ERP'][part_id], context['baseline'][part_id]) for part_id in units}
+    data, baseline = read_amplitudes(section['path'], section['window'], section['epoch_store_path'], units)
+    return {part_id: (data[data['part_id'] == part_id], baseline[baseline['part_id'] == part_id]) for part_id in units}
+
+
+def _variables_parts(section):
+    return section['path'] + 'lmer/' + output_name(section['window'], section.get('rois')) + '_parts/'
+
+
+def variables_unit(section, part_id, payload, audit):
+    data, baseline = payload
+    elist_info = None
+    if section['mode'] in ('audio', 'video'):
+        elist_info = eventlist_info(section['path'], part_id, _shared['info'], _shared['info_index'], audit)
+    table = variables_table(section['mode'], data, baseline, _shared['info'], _shared['info_index'], _shared['electrode'],
+                            elist_info, _rois(section), audit)
+    output_format = section.get('output_format', 'csv')
+    if output_format == 'csv': # participants are combined into one csv once all have run
+        os.makedirs(_variables_parts(section), exist_ok=True)
+        with _untraced(), atomic_write(_variables_parts(section) + part_id + '.csv') as f:
+            table.reset_index(drop=True).to_csv(f)
+        return [_variables_parts(section) + part_id + '.csv']
+    return [write_long_table(table, section['path'] + 'lmer/' + output_name(section['window'], section.get('rois')),
+                             output_format, section['mode'])]
+
+
+# Numbering the rows of a csv fragment from offset (its first column). Returns the number of rows
+def _renumber(path, offset):
+    rows = 0
+    with open(path, 'rb') as f, atomic_write(path) as output:
+        output.write(f.readline())
+        for rows, line in enumerate(f, 1):
+            output.write(str(offset + rows - 1).encode() + line[line.index(b','):])
+    return rows
+
+
+# Combining the participants of the variables stage into one csv, as written by preprocessing_variables.py (one index over all
+# rows). Each unit writes the csv of its participant, rows numbered from 0; they are numbered again only for the participants run
+# or whose first row moved, and the csv is their concatenation without their headers. fragments.json keeps the first row and rows
+# of each fragment
+def variables_finish(section, ran):
+    path = section['path'] + 'lmer/' + output_name(section['window'], section.get('rois'))
+    if section.get('output_format', 'csv') != 'csv' or (not ran and os.path.exists(path + '.csv')):
+        return None
+    parts = _variables_parts(section)
+    fragments = {}
+    if os.path.exists(parts + 'fragments.json'):
+        with open(parts + 'fragments.json') as f:
+            fragments = json.load(f)
+
+    offset = 0
+    for part_id in part_ids(section):
+        fragment = fragments.get(part_id)
+        if part_id in ran or fragment is None or fragment[0] != offset:
+            fragment = fragments[part_id] = [offset, _renumber(parts + part_id + '.csv', offset)]
+        offset += fragment[1]
+    with atomic_write(parts + 'fragments.json', 'w') as f:
+        json.dump(fragments, f)
+
+    with atomic_write(path + '.csv') as output:
+        for i, part_id in enumerate(part_ids(section)):
+            with open(parts + part_id + '.csv', 'rb') as f:
+                header = f.readline()
+                if i == 0:
+                    output.write(header)
+                shutil.copyfileobj(f, output, 1 << 24)
+    return path + '.csv'
+
+
+# LIMO stage: one unit per participant, inputs are its exported eventlist and the design matrix
+def limo_units(section, memo, context):
+    shared = [file_hash(path, memo) for path in section['sources'].values()]
+    return {part_id: _unit_hash(section, shared, file_hash(limo_regressors.participant_paths(section['path'], part_id)[0], memo))
+            for part_id in part_ids(section)}
+
+
+def limo_shared(section, units):
+    cache_path = os.path.splitext(next(iter(section['sources'].values())))[0] + '.pkl'
+    return design_matrix(load_store(section['sources'], cache_path), section['mode'])
+
+
+def limo_unit(section, part_id, payload, audit):
+    info, info_index = _shared
+    return [limo_regressors.write_participant(part_id, section['path'], section.get('output_format', 'txt'), audit=audit,
+                                              info=info, info_index=info_index)]
+
+
+# Functions of each stage: units and their hashes, shared settings (loaded once per worker), payload of each unit (sent with it),
+# one unit, and a final step after the units
+STAGE_FUNCTIONS = {
+    'design_matrix': (design_matrix_units, None, None, design_matrix_unit, None),
+    'eventlist': (eventlist_units, eventlist_shared, None, eventlist_unit, None),
+    'variables': (variables_units, variables_shared, variables_payloads, variables_unit, variables_finish),
+    'limo': (limo_units, limo_shared, None, limo_unit, None),
+}
+
+
+# Pausing the tracing of allocations, which slows down the csv writer of pandas several times (the allocations of the block are
+# left out of the peak memory of the unit)
+@contextmanager
+def _untraced():
+    global _paused_peak
+    _paused_peak = max(_paused_peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    try:
+        yield
+    finally:
+        tracemalloc.start()
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+    tracemalloc.start()
+
+
+# Running one unit, with its wall time, peak memory and row audit
+def _run_unit(task):
+    global _paused_peak
+    stage, section, unit, payload = task
+    audit = []
+    _paused_peak = 0
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    outputs = STAGE_FUNCTIONS[stage][3](section, unit, payload, audit)
+    return {'outputs': outputs, 'seconds': time.perf_counter() - start,
+            'peak_memory_mb': max(_paused_peak, tracemalloc.get_traced_memory()[1]) / 2 ** 20, 'audit': audit}
+
+
+def read_state(state_path):
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {'files': {}, 'stages': {}}
+
+
+def write_state(state, state_path):
+    with atomic_write(state_path, 'w') as f:
+        json.dump(state, f, indent=1)
+
+
+# Running a stage: the units whose inputs changed (all with force) in a process pool. The state is written as each unit
+# completes, so that if one fails the others are not run again. Returns the units that ran
+def run_stage(stage, section, state, state_path, force=False, workers=None):
+    units_function, shared_function, payload_function, _, finish_function = STAGE_FUNCTIONS[stage]
+    context = {}
+    hashes = units_function(section, state['files'], context)
+    previous = state['stages'].setdefault(stage, {})
+    to_run = [unit for unit, unit_hash in hashes.items()
+              if force or unit not in previous or previous[unit]['hash'] != unit_hash
+              or not all(os.path.exists(output) for output in previous[unit]['outputs'])]
+    if to_run:
+        shared = shared_function(section, to_run) if shared_function is not None else None
+        payloads = payload_function(section, to_run, context) if payload_function is not None else {}
+        tasks = [(stage, section, unit, payloads.get(unit)) for unit in to_run]
+        failed = {}
+        with ProcessPoolExecutor(max_workers=1 if len(to_run) == 1 else workers, initializer=_init_worker,
+                                 initargs=(shared,)) as pool:
+            futures = {pool.submit(_run_unit, task): task[2] for task in tasks}
+            for future in as_completed(futures):
+                unit = futures[future]
+                try:
+                    record = future.result()
+                except Exception as error:
+                    failed[unit] = error
+                    previous.pop(unit, None) # run again next time, even if its inputs did not change
+                    continue
+                record['hash'] = hashes[unit]
+                previous[unit] = record
+                write_state(state, state_path)
+        if failed:
+            error = next(iter(failed.values()))
+            raise RuntimeError('Stage ' + stage + ' failed for ' + ', '.join(failed) + ': ' + repr(error)) from error
+    if finish_function is not None:
+        start = time.perf_counter()
+        output = finish_function(section, to_run)
+        if output is not None:
+            previous['combined'] = {'hash': '', 'outputs': [output], 'seconds': time.perf_counter() - start,
+                                    'peak_memory_mb': None, 'audit': []}
+            to_run.append('combined')
+    return to_run
+
+
+# One row per unit run: wall time, peak memory and the merges that changed the number of rows
+def report(state, ran):
+    rows = []
+    for stage, units in ran.items():
+        for unit in units:
+            record = state['stages'][stage][unit]
+            lost = [step['step'] + ' ' + str(step['rows_in']) + ' -> ' + str(step['rows_out']) for step in record['audit']
+                    if step['rows_out'] != step['rows_in']]
+            rows.append({'stage': stage, 'unit': unit, 'seconds': record['seconds'], 'peak_memory_mb': record['peak_memory_mb'],
+                         'rows_changed': ', '.join(lost)})
+    return pd.DataFrame(rows, columns=['stage', 'unit', 'seconds', 'peak_memory_mb', 'rows_changed'])
+
+
+# Running the stages of a configuration, in pipeline order. Returns the report of the units that ran
+def run_pipeline(config, stages=None, force=False, workers=None):
+    state_path = config.get('state_path', 'pipeline_state.json')
+    state = read_state(state_path)
+    ran = {}
+    for stage in STAGES:
+        if stage in config and (stages is None or stage in stages):
+            ran[stage] = run_stage(stage, config[stage], state, state_path, force, workers or config.get('workers'))
+            write_state(state, state_path) # the units already run are kept if a later stage fails
+    return report(state, ran)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Running the preprocessing stages whose inputs changed')
+    parser.add_argument('config', help='configuration file (json), see the top of pipeline.py')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, help='stages to run (all stages of the configuration by default)')
+    parser.add_argument('--force', action='store_true', help='running all units, even if their inputs did not change')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    arguments = parser.parse_args()
+
+    with open(arguments.config) as f:
+        config = json.load(f)
+    pd.set_option('display.width', 400)
+    ran = run_pipeline(config, arguments.stages, arguments.force, arguments.workers)
+    print('All outputs are up to date' if ran.empty else ran.to_string(index=False))
@@ -9,40 +9,42 @@
 # Importing packages & setting display
 import pandas as pd
 import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from design_matrix import load_store
+from presentation_log import read_session
 
 pd.set_option('display.width', 400)
 pd.set_option('display.max_columns', 40)
 pd.set_option('display.max_rows', 500)
 pd.options.mode.chained_assignment = None  # default='warn'
 
-# Iterating across all participants to create new eventlists
-for i in range (1, 26):
+# Word onset table, loaded once by the driver and handed to each worker process when it starts
+_info_onset = None
+
+
+# Reading word onsets (relative to video onset) from the design matrix. Excel parsing is the slowest step, so this is done once per cohort
+# and the parsed table is cached next to the Excel file (see design_matrix.py)
+def load_word_onsets(info_path):
+    info = load_store({'audio': info_path}, os.path.splitext(info_path)[0] + '.pkl')['tables']['audio']
+    return info[['bin_id', 'onset', 'word', 'sentence_id']]
 
-    partID = 'part'+str(i)
-    file_path = '/Users/claudia/OneDrive - University College London/surprisal_audio/data/preprocessing/'
+
+# Creating the word-level eventlist of one participant, returned as a dataframe with the original eventlist columns. If audit is
+# a list, the number of rows before and after each merge is appended to it
+def build_eventlist(part_id, file_path, info_onset, audit=None):
 
     ## Reading original eventlist, containing video onsets
-    eventlist = pd.read_csv(file_path+'eventlist/original/eventlist_'+partID+'.txt',
+    eventlist = pd.read_csv(file_path+'eventlist/original/eventlist_'+part_id+'.txt',
                             skiprows=20, # Excluding 20 'non-editable headers', eventlist works without it
                             sep="\t")
 
     ## Reading log generated by Presentation software to get video sequence. Each participants has two log files (a & b).
-    log_a = pd.read_csv(file_path+'log/'+partID+'_a.log',
-                      skiprows=3, # Excluding 3 lines header, with scenario info
-                      skipfooter=13, # Excluding 13 lines of footers, with scenario info
-                      sep="\t",
-                      engine='python')
-
-    log_b = pd.read_csv(file_path+'log/'+partID+'_b.log',
-                      skiprows=3, # Excluding 3 lines header, with scenario info
-                      skipfooter=13, # Excluding 13 lines of footers, with scenario info
-                      sep="\t",
-                      engine='python')
-
-    log_a_events = log_a[log_a['Event Type'] == 'Sound'] # Get video sequence
-    log_b_events = log_b[log_b['Event Type'] == 'Sound']
-    log_events = pd.concat([log_a_events,log_b_events])
-    log_events.reset_index(inplace = True)
+    ## Only the 'Sound' events are kept, header and footer blocks with scenario info are detected by the reader
+    log_events = read_session([file_path+'log/'+part_id+'_a.log', file_path+'log/'+part_id+'_b.log'],
+                              event_types=('Sound',), columns=('Event Type', 'Code')) # Get video sequence
 
     ## Mapping eventlist to log
     #eventlist_exp4['sentenceID'] = log_events ['Code']
@@ -55,6 +57,8 @@ for i in range (1, 26):
     log_events_use = log_events[['passage_id', 'Code']]
     log_events_use['passage_id'] = log_events_use['passage_id'].astype('int')
     eventlist_onset_code = pd.merge(eventlist_onset, log_events_use, on = 'passage_id', how = 'left')
+    if audit is not None:
+        audit.append({'step': 'log', 'rows_in': len(eventlist_onset), 'rows_out': len(eventlist_onset_code)})
 
     eventlist_onset_code.drop(
         eventlist_onset_code[(eventlist_onset_code['passage_id'] == 49)|
@@ -64,15 +68,17 @@ for i in range (1, 26):
     )
 
     ## Calculating word onset
-    info = pd.read_excel('/Users/claudia/OneDrive - University College London/surprisal_audio/stimuli/word_merged_audio.xlsx')
-    info_onset = info[['bin_id', 'onset', 'word', 'sentence_id']]
     info_onset_combined = pd.merge(eventlist_onset_code, info_onset, left_on=['Code'], right_on=['sentence_id'], how='left')
+    if audit is not None:
+        audit.append({'step': 'word onsets', 'rows_in': len(eventlist_onset_code), 'rows_out': len(info_onset_combined)})
     info_onset_combined['word_onset'] = info_onset_combined['onset'] + info_onset_combined['      onset']
     info_onset_combined['diff'] = info_onset_combined['word_onset'].diff()*1000
 
     ## Creating new eventlist
     new_eventlist = info_onset_combined[['bin_id', 'word_onset', 'diff']]
     new_eventlist.reset_index(inplace = True)
+    if audit is not None:
+        audit.append({'step': 'words with onset', 'rows_in': len(new_eventlist), 'rows_out': int(new_eventlist.notna().all(axis=1).sum())})
     new_eventlist = new_eventlist.dropna()
 
     new_eventlist['bin_id'] = new_eventlist['bin_id'].astype('int')
@@ -87,6 +93,39 @@ for i in range (1, 26):
     new_eventlist = new_eventlist[['index', 'bepoch', 'bin_id', 'label', 'word_onset', 'diff', 'dura', 'b_flags', 'a_flags', 'enable', 'bin']]
     new_eventlist.columns = eventlist.columns
 
-    new_eventlist.to_csv(file_path+'eventlist/word/eventlist_word_'+partID+'.txt',
+    return new_eventlist
+
+
+# Writing the eventlist of one participant. info_onset is the word onset table (see load_word_onsets), by default the one shared
+# with the worker by generate_cohort
+def write_eventlist(part_id, file_path, audit=None, info_onset=None):
+    if info_onset is None:
+        info_onset = _info_onset
+    if info_onset is None:
+        raise ValueError('No word onset table: pass info_onset (see load_word_onsets) or run the participants with generate_cohort')
+    new_eventlist = build_eventlist(part_id, file_path, info_onset, audit)
+    output = file_path+'eventlist/word/eventlist_word_'+part_id+'.txt'
+    new_eventlist.to_csv(output,
                          index=None, sep='\t', mode='w',
                          quoting=csv.QUOTE_NONE) # this function from package csv somehow solve the additional quatation mark issue!
+    return output
+
+
+def _init_worker(info_onset):
+    global _info_onset
+    _info_onset = info_onset
+
+
+# Creating eventlists for a cohort of participants in a process pool. The word onset table is passed once to each worker rather than once per participant
+def generate_cohort(part_ids, file_path, info_onset, workers=None):
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(info_onset,)) as pool:
+        return list(pool.map(partial(write_eventlist, file_path=file_path), part_ids))
+
+
+if __name__ == '__main__':
+    file_path = '/Users/claudia/OneDrive - University College London/surprisal_audio/data/preprocessing/'
+    info_path = '/Users/claudia/OneDrive - University College London/surprisal_audio/stimuli/word_merged_audio.xlsx'
+
+    # Iterating across all participants to create new eventlists
+    info_onset = load_word_onsets(info_path)
+    generate_cohort(['part'+str(i) for i in range (1, 26)], file_path, info_onset)
@@ -15,90 +15,133 @@
 # Importing modules and setting display
 import pandas as pd
 
+from design_matrix import design_matrix, load_store, lookup_column
+from electrode_roi import average_rois, read_coordinates, roi_coordinates
+from epoch_store import window_means
+from erplab_eventlist import read_eventlist_export
+from lmer_join import build_long_table, read_measurement
+from lmer_output import write_long_table
+
 pd.set_option('display.width', 400)
 pd.set_option('display.max_columns', 40)
 pd.set_option('display.max_rows', 500)
 pd.options.mode.chained_assignment = None  # default='warn'
 
-# Setting parameters based on audio/video data, change mode below according to need
-#mode = 'audio'
-mode = 'video'
-#mode = 'video_replication'
-path = '/Users/yezhang/Library/CloudStorage/OneDrive-UniversityCollegeLondon/surprisal_audio/data_' + mode + '/'
-
-if mode == 'audio':
-    part_num = 25
-    skipnum = 4733
-    # Reading design matrix according to data slice
-    info = pd.read_csv('/Users/yezhang/OneDrive - University College London/surprisal_audio/stimuli/word_merged_audio_seq.csv')
-    info['bin_id'] = info['bin_id_audio']
-elif mode == 'video':
-    part_num = 30
-    skipnum = 2674
-    info = pd.read_csv('/Users/yezhang/OneDrive - University College London/surprisal_audio/stimuli/word_merged_audio_seq.csv')
-    info['bin_id'] = info['bin_id_video']
-elif mode == 'video_replication':
-    info = pd.read_csv('/Users/yezhang/Library/CloudStorage/OneDrive-UniversityCollegeLondon/surprisal_audio/stimuli/word_merged_replication_surprisal.csv')
-else:
-    print('Error in mode!')
-
-# Reading electrode positions
-electrode = pd.read_csv('/Users/yezhang/OneDrive - University College London/surprisal_audio/stimuli/channel_coordinate.csv')
-electrode.columns = ['electrode', 'x', 'y', 'z']
-electrode['electrode'] = electrode['electrode'].str.strip(' ')
-
-# Loading data & baseline
-baseline = pd.read_csv(path + 'lmer/baseline.txt', sep="\t",
-                       usecols=['       value', '     chlabel', '        bini', 'ERPset'])
-baseline.columns = ['baseline', 'electrode', 'bin_id', 'part_id']
-
-data = pd.read_csv(path + 'lmer/300-500.txt', sep="\t",
-                   usecols=['       value', '     chlabel', '        bini', 'ERPset'])
-data.columns = ['ERP', 'electrode', 'bin_id', 'part_id']
-
-# Merging data with design matrix & baseline
-data_baselined = pd.merge(data, baseline, on=['electrode', 'bin_id', 'part_id'])
-data_baselined['electrode'] = data_baselined['electrode'].str.strip(' ')
-data_baselined_removed = data_baselined[(data_baselined['ERP']!= 0) | (data_baselined['baseline']!= 0)]
-
-data_baselined_removed_info = pd.merge(data_baselined_removed, info, on = ['bin_id'])
-
-data_baselined_removed_info_location = pd.merge(data_baselined_removed_info, electrode,on=['electrode'])
-
-if mode == 'audio' or mode == 'video':
-    # Extracting info from eventlist (AR, sentence sequence)
-    elist_full = []
-    info_filtered = info[info['bin_id'].notnull()] # there are empty entries in video mode, filtering out to make sure there is not bug in mapping
-    sentence_dic = dict(zip(info_filtered.bin_id, info_filtered.sentence_id))
-    for i in range (1, part_num+1):
-        part_id = 'part' + str(i)
-        elist_slice = pd.read_csv(path + 'preprocessing/eventlist/export_ar/eventlist_export_AR_' + str(part_id) + '.txt',
-            sep="\t", skiprows=skipnum, header=None, usecols=[2, 7])
-        elist_slice.columns = ['bin_id', 'ar']
-        elist_slice['part_id'] = part_id
-
-        # Somehow there's error when syncing AR info with ERP in audio data. Therefore do it manually here. Remove if not needed
-        elist_slice['ar_good'] = elist_slice['ar'].apply(lambda x: True if x == '    00000000     00000000' else False)
-
-        elist_slice['sentence_id'] = elist_slice['bin_id'].map(sentence_dic)
-        sentence_order = elist_slice.groupby('sentence_id', sort=False).count().reset_index()['sentence_id'].reset_index()
-        sentence_order.columns = ['sentence_order', 'sentence_id']
-        elist_slice_order = pd.merge(elist_slice, sentence_order, on = 'sentence_id')
-
-        elist_full.append(elist_slice_order)
-    elist_info = pd.concat(elist_full)
-
-    # Merging data with AR lable and sentence sequence
-    data_baselined_removed_info_location_elist = pd.merge(data_baselined_removed_info_location, elist_info, on=['part_id', 'bin_id'])
-    data_baselined_removed_info_location_elist.drop(columns=
-        ['meaningful_gesture_prev', 'beat_gesture_prev', 'gesture_corres_prev', 'mouth_dist_prev', 'ar', 'sentence_id_y'], inplace=True
-    )
-
-    # Saving final file
-    data_baselined_removed_info_location_elist.to_csv(path + 'lmer/300-500_info.csv')
-    
-elif mode == 'video_replication':
-    data_baselined_removed_info_location['ar_good'] = True # Replication data didn't have the artifact syncing error, so all data are good
-    # sentence order was not used in the model, so the part is skipped for the replication data.
-    # Saving final file
-    data_baselined_removed_info_location.to_csv(path + 'lmer/300-500_info.csv')
\ No newline at end of file
+# Design matrix columns left out of the audio & video tables
+DROP_COLUMNS = ['meaningful_gesture_prev', 'beat_gesture_prev', 'gesture_corres_prev', 'mouth_dist_prev', 'sentence_id_y']
+
+
+# Name of the final file, e.g. 300-500_info, or 300-500_roi_info for ROI averages
+def output_name(window, rois=None):
+    return str(window[0]) + '-' + str(window[1]) + ('_info' if rois is None else '_roi_info')
+
+
+# Loading data & baseline: read from the ERPlab exports (lmer/300-500.txt & lmer/baseline.txt), or computed for any window from
+# an epoch store (see epoch_store.py), both windows in one pass over the epochs
+def read_amplitudes(path, window, epoch_store_path=None, part_ids=None):
+    if epoch_store_path is None:
+        return tuple(read_measurement(export_path, name) for name, export_path in export_paths(path, window).items())
+    amplitudes = window_means(epoch_store_path, {'ERP': window, 'baseline': (-100, 0)}, part_ids)
+    return amplitudes.drop(columns='baseline'), amplitudes.drop(columns='ERP')
+
+
+# Paths of the ERPlab exports of all participants: mean amplitudes in the window and in the baseline
+def export_paths(path, window):
+    return {'ERP': path + 'lmer/' + str(window[0]) + '-' + str(window[1]) + '.txt', 'baseline': path + 'lmer/baseline.txt'}
+
+
+# Path of the eventlist of a participant exported after artifact rejection
+def eventlist_path(path, part_id):
+    return path + 'preprocessing/eventlist/export_ar/eventlist_export_AR_' + part_id + '.txt'
+
+
+# Extracting info from the eventlist of one participant (AR, sentence sequence)
+def eventlist_info(path, part_id, info, info_index, audit=None):
+    elist = read_eventlist_export(eventlist_path(path, part_id))
+    elist_slice = pd.DataFrame({'bin_id': elist['bin_id']})
+    elist_slice['part_id'] = part_id
+
+    # Somehow there's error when syncing AR info with ERP in audio data. Therefore do it manually here. Remove if not needed
+    elist_slice['ar_good'] = elist['ar_good']
+
+    elist_slice['sentence_id'] = lookup_column(info, info_index, 'sentence_id', elist['bin_id']) # empty bin_id entries in video mode are not indexed
+    sentence_order = elist_slice.groupby('sentence_id', sort=False).count().reset_index()['sentence_id'].reset_index()
+    sentence_order.columns = ['sentence_order', 'sentence_id']
+    elist_slice_order = pd.merge(elist_slice, sentence_order, on = 'sentence_id')
+    if audit is not None:
+        audit.append({'step': 'sentence order', 'rows_in': len(elist_slice), 'rows_out': len(elist_slice_order)})
+    return elist_slice_order
+
+
+# Merging data with baseline, design matrix, electrode positions, AR lable and sentence sequence (see lmer_join.py). With rois,
+# ERP and baseline are first averaged within each ROI (see electrode_roi.py) and the ROIs take the place of the electrodes,
+# with the mean of their coordinates
+def variables_table(mode, data, baseline, info, info_index, electrode, elist_info=None, rois=None, audit=None):
+    if rois is not None:
+        data, baseline = average_rois(data, rois, 'ERP'), average_rois(baseline, rois, 'baseline')
+        electrode = roi_coordinates(electrode, rois)
+    if mode == 'audio' or mode == 'video':
+        return build_long_table(data, baseline, info, electrode, elist_info, drop_columns=DROP_COLUMNS, info_index=info_index,
+                                audit=audit)
+    data_info = build_long_table(data, baseline, info, electrode, info_index=info_index, audit=audit)
+    data_info['ar_good'] = True # Replication data didn't have the artifact syncing error, so all data are good
+    return data_info
+
+
+# Running the whole script for one data slice: the design matrix from the compiled sources, data & baseline, electrode positions and
+# eventlist info of the participants merged and saved as lmer/300-500_info. Returns the path written
+def write_variables(mode, path, sources, coordinates_path, part_ids, window=(300, 500), epoch_store_path=None, rois=None,
+                    output_format='csv'):
+    info, info_index = design_matrix(load_store(sources, path + 'design_matrix.pkl'), mode)
+
+    # Loading data & baseline, and reading electrode positions
+    data, baseline = read_amplitudes(path, window, epoch_store_path)
+    electrode = read_coordinates(coordinates_path)
+
+    # Extracting info from eventlist (AR, sentence sequence). Note that the pipeline did not include it for the replication data,
+    # and sentence order was not used in the model
+    elist_info = None
+    if mode == 'audio' or mode == 'video':
+        elist_info = pd.concat([eventlist_info(path, part_id, info, info_index) for part_id in part_ids])
+
+    # Merging and saving final file
+    data_info = variables_table(mode, data, baseline, info, info_index, electrode, elist_info, rois)
+    return write_long_table(data_info, path + 'lmer/' + output_name(window, rois), output_format, mode)
+
+
+if __name__ == '__main__':
+    # Setting parameters based on audio/video data, change mode below according to need (or run the stage from pipeline.py)
+    #mode = 'audio'
+    mode = 'video'
+    #mode = 'video_replication'
+    path = '/Users/yezhang/Library/CloudStorage/OneDrive-UniversityCollegeLondon/surprisal_audio/data_' + mode + '/'
+    # Mean amplitudes are read from the ERPlab exports (lmer/300-500.txt & lmer/baseline.txt), or computed for any window from an
+    # epoch store (see epoch_store.py), e.g. epoch_store_path = path + 'epochs/' and window = (300, 600)
+    epoch_store_path = None
+    window = (300, 500) # ms
+    # ROIs averaged before the export (see electrode_roi.py), None to keep one row per electrode. E.g. {'N400': ROIS['N400']},
+    # the Michaelov et al. ROIs {name: ROIS[name] for name in MICHAELOV_ROIS}, or cluster_electrodes(read_coordinates(...), 6),
+    # with ROIS, MICHAELOV_ROIS and cluster_electrodes imported from electrode_roi.
+    # The ROI table is saved next to the electrode one, as 300-500_roi_info
+    rois = None
+    # Format of the final file: 'csv' (e.g. 300-500_info.csv), or 'parquet'/'feather' (300-500_info/, partitioned by mode and part_id, needs pyarrow)
+    output_format = 'csv'
+
+    # Reading design matrix according to data slice, from the compiled design matrices (see design_matrix.py)
+    stimuli_path = '/Users/yezhang/OneDrive - University College London/surprisal_audio/stimuli/'
+    if mode == 'audio':
+        part_num = 25
+        sources = {'audio_seq': stimuli_path + 'word_merged_audio_seq.csv'}
+    elif mode == 'video':
+        part_num = 30
+        sources = {'audio_seq': stimuli_path + 'word_merged_audio_seq.csv'}
+    elif mode == 'video_replication':
+        part_num = 0 # eventlists are not read for the replication data
+        sources = {'replication': '/Users/yezhang/Library/CloudStorage/OneDrive-UniversityCollegeLondon/surprisal_audio/stimuli/word_merged_replication_surprisal.csv'}
+    else:
+        print('Error in mode!')
+
+    # Merging data, baseline, design matrix, electrode positions and eventlist info, and saving the final file
+    coordinates_path = '/Users/yezhang/OneDrive - University College London/surprisal_audio/stimuli/channel_coordinate.csv'
+    write_variables(mode, path, sources, coordinates_path, ['part' + str(i) for i in range(1, part_num + 1)], window,
+                    epoch_store_path, rois, output_format)
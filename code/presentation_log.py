@@ -0,0 +1,53 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module reads the .log files written by the Presentation software during the experiment.
+# A log has a few lines of scenario info, then the event table (one row per event), then a stimulus summary table as footer.
+# Instead of parsing the whole file and cutting fixed numbers of header/footer lines, the reader locates the event table itself and
+# streams through it line by line, keeping only the requested event types (e.g. 'Sound', which marks each video onset).
+
+################################################################
+
+import pandas as pd
+
+
+# Streaming the event table of one log, yielding the requested columns of rows whose 'Event Type' is in event_types
+def iter_log_events(path, event_types=('Sound',), columns=('Event Type', 'Code')):
+    with open(path) as f:
+        # The event table header is the first line with an 'Event Type' field, after the scenario info lines
+        for line in f:
+            header = line.rstrip('\r\n').split('\t')
+            if 'Event Type' in header:
+                break
+        else:
+            raise ValueError('No event table found in ' + path)
+        type_index = header.index('Event Type')
+        column_index = [header.index(column) for column in columns]
+
+        started = False
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                if started: # a blank line after the events marks the start of the footer
+                    break
+                continue
+            values = line.split('\t')
+            if values[0] == 'Event Type': # footer header, in case the blank line is missing
+                break
+            started = True
+            if len(values) > type_index and values[type_index] in event_types:
+                yield tuple(values[i] if i < len(values) else '' for i in column_index)
+
+
+# Reading the requested events of one log into a dataframe (all values as strings)
+def read_log(path, event_types=('Sound',), columns=('Event Type', 'Code')):
+    return pd.DataFrame(list(iter_log_events(path, event_types, columns)), columns=list(columns))
+
+
+# Reading the requested events of all logs of a session (e.g. part1_a.log and part1_b.log), in the given order
+def read_session(paths, event_types=('Sound',), columns=('Event Type', 'Code')):
+    rows = []
+    for path in paths:
+        rows.extend(iter_log_events(path, event_types, columns))
+    return pd.DataFrame(rows, columns=list(columns))
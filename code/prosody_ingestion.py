@@ -0,0 +1,124 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module builds the audio design matrix from the prosodic prominence of each word (the .prom.disc files of the GestureAudio
+# and NoGestureAudio folders) and the word information of Zhang et al., 2021 (WordMerged_total.csv).
+# All prominence files are read concurrently and combined in memory: sentences in natural order (1G, 2G... 103G, then 1S...),
+# silences (_SIL_) removed, and each word joined with its row of WordMerged_total.csv by sentence, word and occurrence of the
+# word in the sentence (so that repeated words, e.g. 'the', are not multiplied). The result is written once with its dtypes
+# (e.g. word_merged_audio.parquet, which design_matrix.py reads directly), Excel only being an optional export.
+
+################################################################
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+PROSODY_COLUMNS = ['sentence_id', 'onset', 'offset', 'word', 'prominence_value', 'boundary_value', 'prominence_label']
+PROSODY_DTYPES = {'sentence_id': str, 'onset': float, 'offset': float, 'word': str, 'prominence_value': float,
+                  'boundary_value': float, 'prominence_label': float}
+
+# Columns of WordMerged_total.csv and their names in the design matrix. SentenceID and its condition ('Unnamed: 3', G/S) form
+# the sentence_id of the prominence files
+WORD_INFO_COLUMNS = {
+    'WordID': 'word_sequence', 'word': 'word', 'bin_id': 'bin_id_old', 'maxf0': 'maxf0', 'minf0': 'minf0', 'meanf0': 'meanf0',
+    'meanIntensity': 'mean_intensity', 'FrequencyNew': 'frequency', 'POSBinary': 'pos_binary', 'POSDetail': 'pos_detail',
+    'lemma': 'lemma', 'wdLen': 'word_length', 'SurprisalFull': 'surprisal',
+}
+INTEGER_COLUMNS = ['word_sequence', 'bin_id_old', 'pos_binary', 'word_length']
+
+
+# Reading one prominence file (one word per line, tab separated, no header)
+def read_prominence(path):
+    return pd.read_csv(path, sep='\t', header=None, names=PROSODY_COLUMNS, dtype=PROSODY_DTYPES)
+
+
+# Prominence files of the folders, with the position of their folder
+def prominence_files(folders):
+    return [(i, os.path.join(folder, name)) for i, folder in enumerate(folders) for name in sorted(os.listdir(folder))
+            if '.prom.disc' in name and os.path.isfile(os.path.join(folder, name))]
+
+
+# Natural order of sentence ids: condition in folder order, then sentence number (1G, 2G... 10G), then the id itself
+def natural_order(sentence_id, condition):
+    number = pd.to_numeric(sentence_id.str.extract(r'^(\d+)', expand=False), errors='coerce')
+    return pd.DataFrame({'condition': condition, 'number': number, 'sentence_id': sentence_id}).sort_values(
+        ['condition', 'number', 'sentence_id'], kind='stable').index
+
+
+# Reading the prominence of all words of the folders (e.g. GestureAudio and NoGestureAudio) in a thread pool. Words are in
+# natural sentence order and in order of the file within a sentence, silences removed, with bin_id_new (row number)
+def read_prosody(folders, workers=None, audit=None):
+    files = prominence_files(folders)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        slices = list(pool.map(read_prominence, [path for _, path in files]))
+    if not slices:
+        raise ValueError('No .prom.disc files in ' + ', '.join(folders))
+
+    condition = np.repeat([folder for folder, _ in files], [len(table) for table in slices])
+    data = pd.concat(slices, ignore_index=True)
+    data = data.loc[natural_order(data['sentence_id'], condition)]
+    words = data['word'] != '_SIL_'
+    if audit is not None:
+        audit.append({'step': 'silences', 'rows_in': len(data), 'rows_out': int(words.sum())})
+    data = data[words].reset_index(drop=True)
+    data.insert(0, 'bin_id_new', np.arange(len(data)))
+    return data
+
+
+# Reading the word information of Zhang et al., 2021 with the design matrix column names and sentence_id
+def read_word_info(path):
+    info = pd.read_csv(path, usecols=list(WORD_INFO_COLUMNS) + ['SentenceID', 'Unnamed: 3'])
+    info['sentence_id'] = info['SentenceID'].astype(str) + info['Unnamed: 3'].astype(str)
+    info = info.drop(columns=['SentenceID', 'Unnamed: 3']).rename(columns=WORD_INFO_COLUMNS)
+    return info
+
+
+# Left join of the words with the word information on sentence_id, word and occurrence of the word in its sentence (counted in
+# word_sequence order)
+def join_word_info(data, info, audit=None):
+    if 'word_sequence' in info.columns:
+        info = info.sort_values('word_sequence', kind='stable')
+    data_occurrence = data.groupby(['sentence_id', 'word'], sort=False).cumcount()
+    info_occurrence = info.groupby(['sentence_id', 'word'], sort=False).cumcount()
+    keys = pd.MultiIndex.from_arrays([info['sentence_id'], info['word'], info_occurrence])
+    positions = keys.get_indexer(pd.MultiIndex.from_arrays([data['sentence_id'], data['word'], data_occurrence]))
+    if audit is not None:
+        audit.append({'step': 'word information', 'rows_in': len(data), 'rows_out': int((positions >= 0).sum())})
+    info_columns = [column for column in info.columns if column not in ('sentence_id', 'word')]
+    joined = info[info_columns].reset_index(drop=True).reindex(positions).reset_index(drop=True)
+    return pd.concat([data.reset_index(drop=True), joined], axis=1)
+
+
+# Setting the dtypes of the design matrix: nullable integers for ids and counts (missing for words without word information),
+# categories for sentence ids (in natural order) and POS
+def design_dtypes(table):
+    dtypes = {column: 'Int64' for column in INTEGER_COLUMNS if column in table.columns}
+    if 'pos_detail' in table.columns:
+        dtypes['pos_detail'] = 'category'
+    table = table.astype(dtypes)
+    table['sentence_id'] = pd.Categorical(table['sentence_id'], categories=table['sentence_id'].unique())
+    return table
+
+
+# Building the audio design matrix from the prosody folders and WordMerged_total.csv. If audit is a list, the number of rows
+# before and after removing silences, and of words found in the word information, is appended to it
+def build_design_matrix(folders, word_info_path, workers=None, audit=None):
+    return design_dtypes(join_word_info(read_prosody(folders, workers, audit), read_word_info(word_info_path), audit))
+
+
+# Writing the design matrix: parquet keeps the dtypes (needs pyarrow), csv as the other design matrices. Optionally also an
+# Excel copy, as written before (word_merged_audio.xlsx)
+def write_design_matrix(table, path, excel_path=None):
+    if path.endswith('.parquet'):
+        table.to_parquet(path, index=False)
+    elif path.endswith('.csv'):
+        table.to_csv(path)
+    else:
+        raise ValueError('Unknown design matrix format ' + path + ', use .parquet or .csv')
+    if excel_path is not None:
+        table.to_excel(excel_path)
+    return path
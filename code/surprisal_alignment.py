@@ -0,0 +1,207 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module aligns the word stream of a language model output (e.g. the *_sentenceInfo_log_probs.csv files) to the words of a
+# design matrix, so that surprisal values can be added to the design matrix even when the two streams are segmented differently
+# (e.g. "don't" vs "do" + "n't", subword tokens), or differ in case and punctuation.
+# Words are normalised (lower case, subword markers and punctuation removed) and subword tokens are joined into the words they
+# start (BERT ##, GPT2 and sentencepiece word start markers). The two word streams are then aligned with the fewest insertions and
+# deletions (Myers' diff, rather than the longest blocks first, so that a word missing from one stream does not move repeated
+# phrases onto their wrong occurrence), and only the stretches that differ are aligned character by character. Each token is
+# assigned to the design word where its first matched character falls, and the index map can then be applied to any number of
+# value columns at once. A token spanning several design words (e.g. "cannot" for "can" + "not") is assigned to the first of
+# them and the others are left without value, as in the original surprisal_mapping; both are flagged in is_seg, and the audit
+# reports how many design words were left without a token.
+
+################################################################
+
+import numpy as np
+import pandas as pd
+
+# Markers of subword tokens (BERT continuation, GPT2 and sentencepiece word start) and everything that is not a letter or digit
+SUBWORD_MARKERS = r'^##|^Ġ|^▁'
+WORD_START_MARKERS = r'^[Ġ▁]'
+NON_WORD = r'[\W_]+'
+
+# Largest number of differing words (or characters, in a stretch that differs) aligned: streams differing more are likely not the
+# same text
+MAX_DIFFERENCES = 5000
+
+
+# Lower case words without subword markers and punctuation. Tokens that are only punctuation become ''
+def normalize_words(words):
+    words = pd.Series(words, dtype=object).fillna('').astype(str)
+    return words.str.replace(SUBWORD_MARKERS, '', regex=True).str.lower().str.replace(NON_WORD, '', regex=True).to_numpy()
+
+
+# Tokens starting a word: all but BERT continuations (##...) and, in streams marking word starts (GPT2, sentencepiece), the tokens
+# without the marker. The first token always starts a word
+def word_starts(tokens):
+    tokens = pd.Series(tokens, dtype=object).fillna('').astype(str)
+    continuation = tokens.str.startswith('##').to_numpy()
+    marked = tokens.str.contains(WORD_START_MARKERS, regex=True).to_numpy()
+    if marked.any():
+        continuation |= ~marked
+    continuation[:1] = False
+    return ~continuation
+
+
+def _offsets(words):
+    return np.concatenate([[0], np.cumsum([len(word) for word in words])]).astype(np.int64)
+
+
+# Length of the common prefix of a[i:] and b[j:], comparing slices of growing then shrinking size
+def _common_length(a, i, b, j):
+    n = min(len(a) - i, len(b) - j)
+    length, step = 0, 1
+    while step:
+        if length + step <= n and a[i + length:i + length + step] == b[j + length:j + length + step]:
+            length += step
+            step *= 2
+        else:
+            step //= 2
+    return length
+
+
+# Diagonal (x - y) from which the furthest path on diagonal k is extended by one edit: an insertion of an item of b from k + 1 or
+# a deletion of an item of a from k - 1, whichever goes further and stays within the n x m grid. None if neither can
+def _previous_diagonal(furthest, k, n, m):
+    insertion = furthest[k + 1] if k + 1 in furthest and furthest[k + 1] - k <= m else -1
+    deletion = furthest[k - 1] + 1 if k - 1 in furthest and furthest[k - 1] < n else -1
+    if insertion < 0 and deletion < 0:
+        return None
+    return k + 1 if insertion >= deletion else k - 1
+
+
+# Runs of matching items (start in a, start in b, length) of a shortest edit script from a to b, two strings or two lists of words
+# (Myers, 1986: time grows with their length times the number of differences)
+def _matching_runs(a, b):
+    n, m = len(a), len(b)
+    furthest, trace = {1: 0}, [] # furthest x reached on each diagonal k = x - y, with d edits
+    for d in range(n + m + 1):
+        if d > MAX_DIFFERENCES:
+            raise ValueError('The word streams differ in more than ' + str(MAX_DIFFERENCES) + ' places, check that they are '
+                             'the same text')
+        trace.append(dict(furthest))
+        for k in range(max(-d, -m), min(d, n) + 1):
+            if (k - d) % 2:
+                continue
+            previous_k = _previous_diagonal(furthest, k, n, m)
+            if previous_k is None:
+                continue
+            x = furthest[previous_k] + (previous_k < k)
+            x += _common_length(a, x, b, x - k)
+            furthest[k] = x
+        if furthest.get(n - m) == n:
+            break
+
+    # Walking back from the end: each edit is followed by a run of matching items
+    runs, x, y = [], n, m
+    for d in range(len(trace) - 1, 0, -1):
+        k = x - y
+        previous_k = _previous_diagonal(trace[d], k, n, m)
+        start_x = trace[d][previous_k] + (previous_k < k)
+        if x > start_x:
+            runs.append((start_x, start_x - k, x - start_x))
+        x = trace[d][previous_k]
+        y = x - previous_k
+    if x > 0:
+        runs.append((0, 0, x))
+    return runs[::-1]
+
+
+# Position of each token character in the design word characters, -1 where a character has no match. Words (tokens joined from
+# each word start) are aligned first, words without letters left out; the characters of the stretches between equal words are
+# then aligned
+def _character_map(design, tokens, starts):
+    design_offsets, token_offsets = _offsets(design), _offsets(tokens)
+    design_text, token_text = ''.join(design), ''.join(tokens)
+    word_offsets = np.append(token_offsets[np.flatnonzero(starts)], len(token_text))
+    token_words = [token_text[start:end] for start, end in zip(word_offsets[:-1], word_offsets[1:])]
+    design_kept = [i for i, word in enumerate(design) if word]
+    token_kept = [i for i, word in enumerate(token_words) if word]
+
+    # Equal words as runs of characters (design start, token start, length), then the stretches between them
+    runs = [(design_offsets[design_kept[d]], word_offsets[token_kept[t]], design_offsets[design_kept[d + size - 1] + 1]
+             - design_offsets[design_kept[d]])
+            for d, t, size in _matching_runs([design[i] for i in design_kept], [token_words[i] for i in token_kept])]
+    character_runs, design_end, token_end = [], 0, 0
+    for design_start, token_start, size in runs + [(len(design_text), len(token_text), 0)]:
+        if design_start > design_end and token_start > token_end:
+            character_runs += [(design_end + d, token_end + t, length) for d, t, length in
+                               _matching_runs(design_text[design_end:design_start], token_text[token_end:token_start])]
+        character_runs.append((design_start, token_start, size))
+        design_end, token_end = design_start + size, token_start + size
+
+    character_map = np.full(len(token_text), -1, dtype=np.int64)
+    for design_start, token_start, length in character_runs:
+        character_map[token_start:token_start + length] = np.arange(design_start, design_start + length)
+    return character_map
+
+
+# Aligning tokens to design words. Returns, for each token, the row of the design word it belongs to (-1 if it is not aligned)
+# and, for each design word, whether its segmentation differs from the tokens (several tokens, or a token spanning several words:
+# only the first of these words gets the token). If audit is a list, the number of design words with a token and of tokens
+# aligned are appended to it, so that words left without value show
+def align_tokens(design_words, tokens, audit=None):
+    design, starts, tokens = normalize_words(design_words), word_starts(tokens), normalize_words(tokens)
+    design_offsets, token_offsets = _offsets(design), _offsets(tokens)
+    character_map = _character_map(design, tokens, starts)
+
+    # Design word of each matched token character, then the first and last word reached by each token
+    n_words = len(design)
+    character_word = np.full(len(character_map), n_words, dtype=np.int64)
+    matched = character_map >= 0
+    character_word[matched] = np.searchsorted(design_offsets, character_map[matched], side='right') - 1
+    token_word = np.full(len(tokens), -1, dtype=np.int64)
+    token_last = np.full(len(tokens), -1, dtype=np.int64)
+    non_empty = np.flatnonzero(token_offsets[1:] > token_offsets[:-1])
+    if len(non_empty):
+        first = np.minimum.reduceat(character_word, token_offsets[non_empty])
+        last = np.maximum.reduceat(np.where(matched, character_word, -1), token_offsets[non_empty])
+        aligned = first < n_words
+        token_word[non_empty[aligned]] = first[aligned]
+        token_last[non_empty[aligned]] = last[aligned]
+
+    tokens_per_word = np.bincount(token_word[token_word >= 0], minlength=n_words)
+    is_seg = tokens_per_word > 1
+    spanning = np.flatnonzero(token_last > token_word)
+    if len(spanning):
+        covered = np.zeros(n_words + 1, dtype=np.int64)
+        np.add.at(covered, token_word[spanning], 1)
+        np.add.at(covered, token_last[spanning] + 1, -1)
+        is_seg |= np.cumsum(covered)[:n_words] > 0
+    if audit is not None:
+        audit.append({'step': 'design words with a token', 'rows_in': n_words, 'rows_out': int((tokens_per_word > 0).sum())})
+        audit.append({'step': 'tokens aligned', 'rows_in': len(tokens), 'rows_out': int((token_word >= 0).sum())})
+    return token_word, is_seg
+
+
+# Applying an alignment to value columns of the token table, all columns at once. Values of the tokens of one word are combined
+# with how='sum' (surprisal of a segmented word is the sum of its parts), 'mean' or 'first'. Words without tokens get NaN.
+# Also returns the tokens of each word (word_mapped) and the segmentation flag (is_seg)
+def map_columns(token_table, token_word, is_seg, columns, word_column='word', how='sum'):
+    n_words = len(is_seg)
+    aligned = np.flatnonzero(token_word >= 0)
+    rows = token_word[aligned]
+    values = token_table[columns].to_numpy(dtype=float)[aligned]
+    counts = np.bincount(rows, minlength=n_words)
+
+    if how == 'first':
+        first = np.full(n_words, -1, dtype=np.int64)
+        first[rows[::-1]] = np.arange(len(rows))[::-1]
+        mapped = np.where((first >= 0)[:, None], values[np.maximum(first, 0)] if len(values) else np.nan, np.nan)
+    else:
+        mapped = np.zeros((n_words, len(columns)))
+        np.add.at(mapped, rows, values)
+        if how == 'mean':
+            mapped /= np.maximum(counts, 1)[:, None]
+        mapped[counts == 0] = np.nan
+
+    words = pd.Series(token_table[word_column].to_numpy()[aligned]).astype(str)
+    word_mapped = words.groupby(rows).agg(' '.join).reindex(range(n_words))
+    output = pd.DataFrame(mapped, columns=columns)
+    output.insert(0, 'word_mapped', word_mapped.to_numpy())
+    output.insert(1, 'is_seg', is_seg)
+    return output
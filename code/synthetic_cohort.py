@@ -0,0 +1,247 @@
+################################################################
+
+# AUDIO & AV SURPRISAL PROJECT
+
+# This module writes a synthetic cohort: fake inputs of the Python preprocessing for any number of participants, built from the
+# real design matrix (data/word_merged_audio_seq.csv) and electrodes (data/channel_coordinate.csv), so that the preprocessing can
+# be run and timed without the EEG data (see benchmark.py). Each participant hears one version (G or S) of every passage, in a
+# random order, and gets:
+# - the original eventlist (20 header lines, one event per video onset and some response button events) and the two Presentation
+#   logs (a & b), as read by preprocessing_generate_eventlist.py
+# - the eventlists exported from ERPlab, with their header block: after artifact rejection (export_ar, some words rejected) for
+#   preprocessing_variables.py and without rejection (export) for LIMO_variables.py
+# - its rows in the ERPlab measurement exports lmer/300-500.txt and lmer/baseline.txt (one per word and electrode, 0 for the
+#   rejected words, as exported by ERPlab)
+# Participants are drawn from the seed and their number only, so part1 is the same in cohorts of 25 and 500 participants.
+# The folders follow the paths of the scripts:
+# stimuli/  word_merged_audio_seq.csv, channel_coordinate.csv and word_merged_audio.csv (design matrix of the eventlists and LIMO)
+# data/     lmer/ and preprocessing/ (eventlist/original, eventlist/word, eventlist/export_ar, eventlist/export, log, LIMO/data/partN)
+# cohort.json holds the settings of the cohort and the pipeline.py configuration to run it.
+
+################################################################
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# bin_id column of the words in each mode
+BIN_COLUMNS = {'audio': 'bin_id_audio', 'video': 'bin_id_video'}
+
+# Passages left out of the word eventlists by preprocessing_generate_eventlist.py (29, 49 and 85, and 101 and 102, whose triggers
+# are the response buttons), so they are not in the ERPlab exports either
+EXCLUDED_PASSAGES = [29, 49, 85, 101, 102]
+
+# Columns of the design matrix used by the eventlists and LIMO (word_merged_audio.xlsx), and their source in word_merged_audio_seq.csv
+AUDIO_COLUMNS = {'bin_id': 'bin_id_audio', 'bin_id_prev': 'bin_id_video', 'surprisal_ngram': 'surprisal_2gram',
+                 'surprisal_gpt': 'surprisal_gpt2'}
+
+EVENTLIST_HEADER = ['# Non-editable header begin --------------------------------------------------------------------------------',
+                    '#', '# data format...............: continuous', '# setname...................: {part_id}',
+                    '# filename..................: {part_id}.set', '# filepath..................: synthetic',
+                    '# nchan.....................: {channels}', '# pnts......................: {points}',
+                    '# srate.....................: 500', '# nevents...................: {events}',
+                    '# generated by (bdf)........: none', '# reported in ..............: none',
+                    '# prog Version..............: 9.0', '# creation date.............: synthetic',
+                    '# user Account..............: synthetic', '#',
+                    '# Non-editable header end --------------------------------------------------------------------------------',
+                    '#', '#', '#']
+ORIGINAL_COLUMNS = '# item\t  bepoch\t  ecode\t      label\t      onset\t        diff\t      dura\t  b_flags\t  a_flags\t  enable\t  bin'
+EXPORT_COLUMNS = '# item\tbepoch\tecode\tlabel\tonset\tdiff\tdura\tflags\tenable\tbin'
+MEASUREMENT_HEADER = '  worklat\t       value\t chindex\t     chlabel\t        bini\t    binlabel\tERPset'
+LOG_COLUMNS = 'Subject\tTrial\tEvent Type\tCode\tTime\tTTime\tUncertainty\tDuration\tUncertainty\tReqTime\tReqDur\tStim Type\tPair Index'
+LOG_FOOTER_COLUMNS = 'Event Type\tCode\tType\tResponse\tRT\tRT Uncertainty\tTime\tUncertainty\tDuration\tUncertainty\tReqTime\tReqDur'
+
+
+# Paths of a cohort folder
+def cohort_paths(root):
+    root = os.path.join(os.path.abspath(root), '')
+    return {'root': root, 'stimuli': root + 'stimuli/', 'data': root + 'data/', 'preprocessing': root + 'data/preprocessing/',
+            'settings': root + 'cohort.json'}
+
+
+# Stimuli of the cohort: the two design matrices and the electrode coordinates. word_merged_audio.csv stands for
+# word_merged_audio.xlsx, with its bin_id, bin_id_prev and LIMO surprisal columns taken from word_merged_audio_seq.csv
+def write_stimuli(stimuli_path):
+    os.makedirs(stimuli_path, exist_ok=True)
+    shutil.copyfile(os.path.join(DATA_PATH, 'word_merged_audio_seq.csv'), stimuli_path + 'word_merged_audio_seq.csv')
+    shutil.copyfile(os.path.join(DATA_PATH, 'channel_coordinate.csv'), stimuli_path + 'channel_coordinate.csv')
+    words = pd.read_csv(stimuli_path + 'word_merged_audio_seq.csv', index_col=0)
+    for column, source in AUDIO_COLUMNS.items():
+        words[column] = words[source]
+    words.to_csv(stimuli_path + 'word_merged_audio.csv', index=False)
+    return words
+
+
+# Sentences heard by one participant, in order: one version of each passage, with the video onset (seconds) of each sentence
+def participant_sentences(sentences, rng):
+    passages = sentences.groupby('passage_id')['sentence_id'].agg(list)
+    heard = [versions[rng.integers(len(versions))] for versions in passages]
+    order = pd.DataFrame({'sentence_id': np.array(heard, dtype=object)[rng.permutation(len(heard))]})
+    order = order.merge(sentences, on='sentence_id', how='left')
+    gaps = rng.uniform(2, 4, len(order))
+    order['video_onset'] = 10 + np.concatenate([[0], np.cumsum(order['duration'].to_numpy() + gaps)[:-1]])
+    return order
+
+
+# Original eventlist: the header block, then one event per video onset (trigger 100 + passage) and response button presses (201, 202)
+def write_original_eventlist(path, part_id, order, rng, response_rate, channels):
+    events = pd.DataFrame({'onset': order['video_onset'], 'ecode': order['passage_id'] + 100})
+    responses = rng.random(len(order)) < response_rate
+    events = pd.concat([events, pd.DataFrame({'onset': order['video_onset'][responses] + order['duration'][responses] + 0.5,
+                                              'ecode': rng.choice([201, 202], int(responses.sum()))})]).sort_values('onset')
+    diff = np.diff(events['onset'].to_numpy(), prepend=0) * 1000
+    header = [line.format(part_id=part_id, channels=channels, points=int(events['onset'].max() * 500) + 5000,
+                          events=len(events)) for line in EVENTLIST_HEADER]
+    rows = [str(i + 1) + '\t0\t' + str(ecode) + '\t""\t' + format(onset, '.4f') + '\t' + format(d, '.2f')
+            + '\t0.0\t00000000 00000000\t1.0\t[    \t]'
+            for i, (onset, ecode, d) in enumerate(zip(events['onset'], events['ecode'], diff))]
+    with open(path + 'eventlist/original/eventlist_' + part_id + '.txt', 'w') as f:
+        f.write('\n'.join(header + [ORIGINAL_COLUMNS] + rows) + '\n')
+
+
+# Presentation logs: the sentences are split between the two sessions (a & b), each sentence is a fixation picture and the sound
+# (coded by its sentence id), with some responses, and the stimulus summary table as footer
+def write_logs(path, part_id, order, rng, response_rate):
+    half = (len(order) + 1) // 2
+    for session, sentence_ids in (('a', order['sentence_id'][:half]), ('b', order['sentence_id'][half:])):
+        lines = ['Scenario - surprisal_audio_' + session, 'Logfile written - 01/01/2020 10:00:00', '', LOG_COLUMNS, '']
+        for trial, sentence_id in enumerate(sentence_ids, start=1):
+            time = trial * 200000
+            lines.append(part_id + '\t' + str(trial) + '\tPicture\tfixation\t' + str(time) + '\t0\t1\t10000\t1\t0\tnext\tother\t0')
+            lines.append(part_id + '\t' + str(trial) + '\tSound\t' + sentence_id + '\t' + str(time + 10000)
+                         + '\t0\t1\t150000\t1\t0\tnext\tother\t0')
+            if rng.random() < response_rate:
+                lines.append(part_id + '\t' + str(trial) + '\tResponse\t1\t' + str(time + 170000) + '\t0\t1')
+        lines += ['', LOG_FOOTER_COLUMNS]
+        lines += ['Picture\tfixation\tother\t\t\t\t' + str(trial * 200000) + '\t1\t10000\t1\t0\tnext'
+                  for trial in range(1, len(sentence_ids) + 1)]
+        with open(path + 'log/' + part_id + '_' + session + '.log', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+# Eventlist exported from ERPlab: the header block, one line per bin descriptor, then one event per word (ecode is the bin)
+def write_eventlist_export(output, part_id, words, flags, bin_num, channels):
+    header = [line.format(part_id=part_id, channels=channels, points=len(words) * 500, events=len(words))
+              for line in EVENTLIST_HEADER[:-2]]
+    header += ['bin ' + str(b) + ',\t# 1,\t""' for b in range(1, bin_num + 1)] + [EXPORT_COLUMNS]
+    diff = np.diff(words['word_onset'].to_numpy(), prepend=0) * 1000
+    rows = [str(i + 1) + '\t' + str(i + 1) + '\t' + str(b) + '\t""\t' + format(onset, '.4f') + '\t' + format(d, '.2f')
+            + '\t0.0\t' + flag + '\t1\t[' + str(b) + ']'
+            for i, (b, onset, d, flag) in enumerate(zip(words['bin'], words['word_onset'], diff, flags))]
+    with open(output, 'w') as f:
+        f.write('\n'.join(header + rows) + '\n')
+
+
+# Rows of one participant in the measurement exports: one per word and electrode. The N400 is more negative for surprising words,
+# and ERPlab exports 0 for the words rejected in artifact rejection
+def measurement_rows(part_id, words, rejected, electrodes, rng):
+    n_words, n_channels = len(words), len(electrodes)
+    surprisal = words['surprisal'].fillna(words['surprisal'].mean()).to_numpy()
+    surprisal = (surprisal - surprisal.mean()) / (surprisal.std() or 1)
+    baseline = rng.normal(0, 1, (n_words, n_channels)) + rng.normal(0, 0.5)
+    erp = 0.5 * baseline - 0.4 * surprisal[:, None] + rng.normal(0, 2, (n_words, n_channels))
+    erp[rejected], baseline[rejected] = 0, 0
+    bins = np.repeat(words['bin'].to_numpy(), n_channels)
+    columns = {'chindex': np.tile(np.arange(1, n_channels + 1), n_words),
+               'chlabel': np.tile(np.array([format(e, '>12') for e in electrodes], dtype=object), n_words),
+               'bini': np.char.mod('%12d', bins), 'binlabel': np.char.add('bin', bins.astype(str)), 'ERPset': part_id}
+    return {name: pd.DataFrame(dict({'value': values.ravel()}, **columns)) for name, values in (('ERP', erp), ('baseline', baseline))}
+
+
+# Writing a synthetic cohort of part_num participants (part1, part2...) in root, in audio or video mode (bins of the exports and
+# measurements: bin_id_audio or bin_id_video). A share of the words is rejected (rejection_rate) and of the sentences followed by a
+# response (response_rate). Returns the settings saved in cohort.json
+def write_synthetic_cohort(root, part_num, mode='audio', window=(300, 500), seed=0, rejection_rate=0.1, response_rate=0.1):
+    paths = cohort_paths(root)
+    if os.path.exists(paths['settings']): # written last, once the cohort is complete
+        os.remove(paths['settings'])
+    preprocessing = paths['preprocessing']
+    for folder in ('eventlist/original', 'eventlist/word', 'eventlist/export_ar', 'eventlist/export', 'log'):
+        os.makedirs(preprocessing + folder, exist_ok=True)
+    os.makedirs(paths['data'] + 'lmer', exist_ok=True)
+
+    words = write_stimuli(paths['stimuli'])
+    electrodes = pd.read_csv(paths['stimuli'] + 'channel_coordinate.csv').iloc[:, 0].str.strip().tolist()
+    words['bin'] = words[BIN_COLUMNS[mode]]
+    words['surprisal'] = words['surprisal_gpt2']
+    sentences = words.groupby('sentence_id', sort=False).agg(passage_id=('passage_id', 'first'), onset=('onset', 'max'),
+                                                                offset=('offset', 'max')).reset_index()
+    sentences['duration'] = sentences[['onset', 'offset']].max(axis=1) + 0.5
+    bin_num = int(words['bin'].max())
+
+    window_name = str(window[0]) + '-' + str(window[1])
+    measurements = {'ERP': open(paths['data'] + 'lmer/' + window_name + '.txt', 'w'),
+                    'baseline': open(paths['data'] + 'lmer/baseline.txt', 'w')}
+    word_num = 0
+    try:
+        for name, f in measurements.items():
+            f.write(MEASUREMENT_HEADER + '\n')
+        for i in range(1, part_num + 1):
+            part_id = 'part' + str(i)
+            rng = np.random.default_rng([seed, i])
+            order = participant_sentences(sentences, rng)
+            write_original_eventlist(preprocessing, part_id, order, rng, response_rate, len(electrodes))
+            write_logs(preprocessing, part_id, order, rng, response_rate)
+
+            # Words of the word eventlist (see preprocessing_generate_eventlist.py), in order of presentation
+            heard = order.loc[~order['passage_id'].isin(EXCLUDED_PASSAGES), ['sentence_id', 'video_onset']]
+            heard = heard.merge(words[['sentence_id', 'onset', 'bin', 'surprisal']], on='sentence_id', how='left')
+            heard = heard[heard['onset'].notna() & heard['bin'].notna()].astype({'bin': 'int64'})
+            heard['word_onset'] = heard['video_onset'] + heard['onset']
+            rejected = rng.random(len(heard)) < rejection_rate
+            flags = np.where(rejected, '    00000001     00000000', '    00000000     00000000')
+            write_eventlist_export(preprocessing + 'eventlist/export_ar/eventlist_export_AR_' + part_id + '.txt', part_id, heard,
+                                   flags, bin_num, len(electrodes))
+            write_eventlist_export(preprocessing + 'eventlist/export/eventlist_export_' + part_id + '.txt', part_id, heard,
+                                   np.full(len(heard), '    00000000     00000000'), bin_num, len(electrodes))
+            os.makedirs(preprocessing + 'LIMO/data/' + part_id, exist_ok=True)
+
+            for name, rows in measurement_rows(part_id, heard, rejected, electrodes, rng).items():
+                rows.insert(0, 'worklat', window_name if name == 'ERP' else '-100-0')
+                rows.to_csv(measurements[name], sep='\t', header=False, index=False, float_format='%.3f')
+            word_num += len(heard)
+    finally:
+        for f in measurements.values():
+            f.close()
+
+    settings = {'part_num': part_num, 'mode': mode, 'window': list(window), 'seed': seed, 'rejection_rate': rejection_rate,
+                'response_rate': response_rate, 'words': word_num, 'measurement_rows': word_num * len(electrodes),
+                'pipeline': pipeline_config(root, part_num, mode, window)}
+    with open(paths['settings'], 'w') as f:
+        json.dump(settings, f, indent=1)
+    return settings
+
+
+# Configuration of pipeline.py for a synthetic cohort: eventlist, variables and limo stages (the design matrix stage needs the
+# prominence files, which are not generated)
+def pipeline_config(root, part_num, mode='audio', window=(300, 500)):
+    paths = cohort_paths(root)
+    return {
+        'state_path': paths['root'] + 'pipeline_state.json',
+        'eventlist': {'path': paths['preprocessing'], 'design_matrix': paths['stimuli'] + 'word_merged_audio.csv',
+                      'part_num': part_num},
+        'variables': {'mode': mode, 'path': paths['data'], 'sources': {'audio_seq': paths['stimuli'] + 'word_merged_audio_seq.csv'},
+                      'coordinates': paths['stimuli'] + 'channel_coordinate.csv', 'window': list(window), 'part_num': part_num},
+        'limo': {'mode': 'limo_' + mode, 'path': paths['preprocessing'],
+                 'sources': {'audio': paths['stimuli'] + 'word_merged_audio.csv'}, 'part_num': part_num},
+    }
+
+
+# Settings of the cohort in root, None if it was not written (or not completely)
+def read_settings(root):
+    path = cohort_paths(root)['settings']
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    # Writing a cohort of 25 participants, e.g. to run pipeline.py on it (the configuration is in cohort.json, under 'pipeline')
+    settings = write_synthetic_cohort('/tmp/synthetic_cohort/25/', 25)
+    print(settings['words'], 'words,', settings['measurement_rows'], 'measurement rows')